@@ -1,220 +1,18 @@
-import random
+import asyncio
+import base64
+import logging
+import time
+from contextlib import contextmanager
 from pathlib import Path
 import os
 
-import matplotlib.pyplot as plt
-import pandas as pd
-from lifelines import CoxPHFitter, KaplanMeierFitter
 from faicons import icon_svg
 from shiny import render, reactive
+from shiny.types import SilentOperationInProgressException
 from shiny.express import ui, input
 
-###
-# General setup and helper functions
-###
-
-NO_PROGRESSION = 'no progression'
-PROGRESSED = 'progressed'
-CENSORED = 'censored'
-DEAD = 'dead'
-
-
-class StudyParticipant:
-    """
-    Class representing a participant in a clinical trial
-    """
-    def __init__(self):
-        self.progress_time = None
-        self.death_time = None
-        self.censor_time = None
-        self.state = NO_PROGRESSION
-    
-    def update_state(self, state, t):
-        self.state = state
-        if state == PROGRESSED:
-            self.progress(t)
-        elif state == CENSORED:
-            self.censor(t)
-        elif state == DEAD:
-            self.die(t)
-
-    def progress(self, t):
-        self.progress_time = t
-
-    def die(self, t):
-        self.death_time = t
-
-    def censor(self, t):
-        self.censor_time = t
-
-
-class Study:
-    """
-    Class representing a clinical trial
-    """
-
-    def __init__(
-            self, n, duration,
-            p_progression_treatment, p_death_treatment, p_censor_treatment,  p_death_given_progression_treatment, p_death_given_censor_treatment,
-            p_progression_control, p_death_control, p_censor_control, p_death_given_progression_control, p_death_given_censor_control
-            ):
-        self.t = 0
-        self.duration = duration
-        self.p_progression_t = p_progression_treatment
-        self.p_death_t = p_death_treatment
-        self.p_censor_t = p_censor_treatment
-        self.p_death_given_progression_t = p_death_given_progression_treatment
-        self.p_death_given_censor_t = p_death_given_censor_treatment
-        self.p_progression_c = p_progression_control
-        self.p_death_c = p_death_control
-        self.p_censor_c = p_censor_control
-        self.p_death_given_progression_c = p_death_given_progression_control
-        self.p_death_given_censor_c = p_death_given_censor_control
-
-        self.treatment_group = [StudyParticipant() for x in range(n)]
-        self.control_group = [StudyParticipant() for x in range(n)]
-        self.complete = False
-
-    def get_treatment_group(self):
-        return self.treatment_group
-    
-    def get_control_group(self):
-        return self.control_group
-    
-    def check_complete(self):
-        if self.t >= self.duration:
-            return True
-
-        for participant in self.treatment_group + self.control_group:
-            if not participant.death_time:
-                return False
-
-        return True
-
-    def simulate_period(self):
-        self.t += 1
-
-        def draw_events(t, participant, p_p, p_d, p_c, p_d_g_p, p_d_g_c):
-
-            if participant.death_time:
-                return
-            
-            if participant.censor_time: 
-                state = random.choices([DEAD, CENSORED], weights = [p_d_g_c, 1-p_d_g_c], k=1)[0]
-
-            elif participant.progress_time:
-                state = random.choices([DEAD, PROGRESSED], weights = [p_d_g_p, 1-p_d_g_p], k=1)[0]
-
-            else:
-                state = random.choices([DEAD, PROGRESSED, CENSORED, NO_PROGRESSION], weights = [p_d, p_p, p_c, 1-p_d-p_p-p_c], k=1)[0]
-
-            if state != participant.state:
-                participant.update_state(state, t)
-            
-        for participant in self.treatment_group:
-            draw_events(self.t, participant, self.p_progression_t, self.p_death_t, self.p_censor_t, self.p_death_given_progression_t, self.p_death_given_censor_t)
-        
-        for participant in self.control_group:
-            draw_events(self.t, participant, self.p_progression_c, self.p_death_c, self.p_censor_c, self.p_death_given_progression_c, self.p_death_given_censor_c)
-
-        self.complete = self.check_complete()
-
-
-
-def simulate_trial(n, duration, stable, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c):
-    study = Study(
-        n=n,
-        duration=duration,
-        p_progression_treatment=p_progression_t,
-        p_death_treatment=p_death_t,
-        p_censor_treatment=p_censor_t,
-        p_death_given_progression_treatment=p_death_given_progression_t,
-        p_death_given_censor_treatment=p_death_given_censor_t,
-        p_progression_control=p_progression_c,
-        p_death_control=p_death_c,
-        p_censor_control=p_censor_c,
-        p_death_given_progression_control=p_death_given_progression_c,
-        p_death_given_censor_control = p_death_given_censor_c
-    )
-
-    if stable:
-        random.seed(42)
-
-    while not study.complete:
-        study.simulate_period()
-
-    data_treatment = [{
-        'participant': f't_{id}', 
-        'group': 1, 
-        't_progression': participant.progress_time,
-        't_death': participant.death_time,
-        't_censor': participant.censor_time,
-        } for id, participant in enumerate(study.get_treatment_group())
-    ]
-
-    data_control = [{
-        'participant': f'c_{id}', 
-        'group': 0, 
-        't_progression': participant.progress_time,
-        't_death': participant.death_time,
-        't_censor': participant.censor_time,
-        } for id, participant in enumerate(study.get_control_group())
-    ]
-
-    data_all = data_treatment + data_control
-
-    df = pd.DataFrame(data_all)
-
-    df['duration'] = duration
-
-    df['pfs_event_time'] = df['t_censor'].combine_first(df['t_progression']).combine_first(df['t_death']).combine_first(df['duration'])
-    df['has_pfs_event'] = df.apply(lambda x: 0 if pd.notna(x['t_censor']) or (pd.isna(x['t_censor']) and pd.isna(x['t_progression']) and pd.isna(x['t_death'])) else 1, axis=1)
-
-    df['os_event_time'] = df['t_death'].combine_first(df['duration'])
-    df['has_os_event'] = df['t_death'].apply(lambda x: 1 if pd.notna(x) else 0)
-
-    return df
-
-def get_hr(data, time_col, event_col, group_col):
-        cph = CoxPHFitter()
-        data_fit = data[[time_col, event_col, group_col]]
-        cph.fit(data_fit, duration_col=time_col, event_col=event_col)
-        hr = float(cph.hazard_ratios_.iloc[0])  
-
-        return hr
-
-def get_hazard_ratio_pfs(df):
-    hr_pfs = get_hr(df, 'pfs_event_time', 'has_pfs_event', 'group')
-
-    return hr_pfs
-
-def get_hazard_ratio_os(df):
-    hr_os = get_hr(df, 'os_event_time', 'has_os_event', 'group')
-
-    return hr_os
-
-def plot_kaplan_meier(data, time_col, event_col, group_col):
-    kmf = KaplanMeierFitter()
-
-    data_treated = data[data[group_col] == 1]
-    data_control = data[data[group_col] == 0]
-
-    kmf.fit(data_treated[time_col], data_treated[event_col], label='Treated')
-    kmf.plot(ci_show=False)
-    kmf.fit(data_control[time_col], data_control[event_col], label='Control')
-    kmf.plot(ci_show=False)
-
-def get_plot_pfs(df):
-    figure = plt.figure()
-    plot_kaplan_meier(df, 'pfs_event_time', 'has_pfs_event', 'group')
-
-    return figure
-
-def get_plot_os(df):
-    figure = plt.figure()
-    plot_kaplan_meier(df, 'os_event_time', 'has_os_event', 'group')
-
-    return figure
+from instrumentation import INSTRUMENTATION, logger, instrument, measure_stage, record_stages
+from shared import prewarm_simulation
 
 ###
 # Shiny application
@@ -224,12 +22,28 @@ link_repo = "https://github.com/lulocher/vokinger-os-pfs-simulation"
 
 N = 20000
 DEFAULT_P = 0.05
+ENGINE = 'numpy'
+
+# participants per arm of the quick previews shown while a larger trial is simulated
+PREVIEW_STAGES = [1000, 10000]
+
+# seconds without input changes before a simulation replacing the one started by the first change begins, so that
+# dragging a slider shows a preview at once and starts a single further simulation at its final position
+DEBOUNCE_DELAY = 0.5
+
+# stage records of a session shown in the diagnostics panel while instrumentation is on
+DIAGNOSTICS_SIZE = 200
 
 MIN_SLIDER = 0.0
 MAX_SLIDER = 0.3
 
 here = Path(__file__).parent
 
+if INSTRUMENTATION:
+    # one JSON line per stage in the server log
+    logging.basicConfig(format='%(message)s')
+    logger.setLevel(logging.INFO)
+
 ui.tags.script(
     src="https://mathjax.rstudio.com/latest/MathJax.js?config=TeX-AMS-MML_HTMLorMML"
 )
@@ -309,6 +123,9 @@ with ui.accordion(id="acc", open=["Introduction", "Parametrization", "Results"])
 
             ui.input_slider('n', 'Participants per Arm', 100, 100000, 10000, step=100)
             ui.input_slider('duration', 'Duration of Trial', 5, 50, 20, step=5)
+            with ui.tooltip(placement="top"):
+                ui.input_checkbox("exact_setting", "Infinite sample", False)
+                'If active, the expected results of an infinitely large trial are computed exactly instead of simulating the participants.'
 
     with ui.accordion_panel("Results"):
         with ui.layout_columns(width=1/3):
@@ -316,34 +133,96 @@ with ui.accordion(id="acc", open=["Introduction", "Parametrization", "Results"])
                 ui.h5('Progression-free Survival')
                 @render.text
                 def hazard_ratio_pfs():
-                    return f'Hazard Ratio: {round(get_hazard_ratio_pfs(simulation_results()), 2)}'
+                    _, hr_pfs, _, preview = simulation_results()
+                    with measure_render('hazard_ratio_pfs'):
+                        return get_hazard_ratio_text(hr_pfs, preview)
                 
-                @render.plot(height=300)
+                @render.ui
                 def kaplan_meier_plot_pfs():
-                    return get_plot_pfs(simulation_results())
+                    data = simulation_results()[0]
+                    with measure_render('kaplan_meier_plot_pfs'):
+                        return get_plot_image(data, 'pfs')
 
             with ui.card():
                 ui.h5('Overall Survival')
                 @render.text
                 def hazard_ratio_os():
-                    return f'Hazard Ratio: {round(get_hazard_ratio_os(simulation_results()), 2)}'
+                    _, _, hr_os, preview = simulation_results()
+                    with measure_render('hazard_ratio_os'):
+                        return get_hazard_ratio_text(hr_os, preview)
                 
-                @render.plot(height=300)
+                @render.ui
                 def kaplan_meier_plot_os():
-                    return get_plot_os(simulation_results())
+                    data = simulation_results()[0]
+                    with measure_render('kaplan_meier_plot_os'):
+                        return get_plot_image(data, 'os')
 
         with ui.panel_conditional('!input.stable_setting'):
-            ui.input_action_button('btn_refresh', 'Simulate new Trial', style='width: 250px; height: 50px; vertical-align: middle', icon=icon_svg('arrow-rotate-right'), class_='btn-primary')
+            ui.input_task_button('btn_refresh', 'Simulate new Trial', label_busy='Simulating...', style='width: 250px; height: 50px; vertical-align: middle', icon=icon_svg('arrow-rotate-right'), class_='btn-primary')
 
+    if INSTRUMENTATION:
+        with ui.accordion_panel("Diagnostics"):
+            @render.data_frame
+            def diagnostics():
+                return get_diagnostics_table(stage_records())
 
-@reactive.Calc
-def simulation_results():
-    click=input.btn_refresh(),
 
-    return simulate_trial(
+def debounce(delay, leading=False):
+    """
+    Reactive calculation that only passes on the value of the decorated one after it did not change for delay seconds.
+    With leading, the first change after such a quiet period is passed on at once, and only the changes following it
+    within delay seconds are held back until the value settles.
+    """
+    def decorator(calc):
+        calc = reactive.Calc(calc)
+        deadline = reactive.Value(None, name=f'{calc.__name__}_deadline')
+        trigger = reactive.Value(0, name=f'{calc.__name__}_trigger')
+        # whether a change is held back until the deadline
+        pending = False
+
+        @reactive.Effect(priority=2)
+        def _restart_timer():
+            nonlocal pending
+            try:
+                calc()
+            finally:
+                with reactive.isolate():
+                    if leading and deadline() is None:
+                        trigger.set(trigger() + 1)
+                    else:
+                        pending = True
+                deadline.set(time.monotonic() + delay)
+
+        @reactive.Effect(priority=1)
+        def _wait():
+            nonlocal pending
+            if deadline() is None:
+                return
+            remaining = deadline() - time.monotonic()
+            if remaining > 0:
+                reactive.invalidate_later(remaining)
+                return
+            with reactive.isolate():
+                deadline.set(None)
+                if pending:
+                    pending = False
+                    trigger.set(trigger() + 1)
+
+        @reactive.Calc
+        @reactive.event(trigger, ignore_init=not leading)
+        def debounced():
+            return calc()
+
+        return debounced
+
+    return decorator
+
+
+@debounce(DEBOUNCE_DELAY, leading=True)
+def simulation_params():
+    return dict(
         n=input.n(),
         duration=input.duration(),
-        stable=input.stable_setting(),
 
         p_death_t=input.p_death_treatment(),
         p_death_c=input.p_death_control(), 
@@ -362,5 +241,182 @@ def simulation_results():
     )
 
 
+@instrument('simulation', arguments=['exact', 'stable'], get_fields=lambda arguments: {'n': arguments['params']['n']})
+def get_simulation_results(params, exact, stable):
+    # numpy, pandas, scipy and matplotlib are only needed from here on, see prewarm_simulation
+    from simulation import get_trial_results, solve_trial, get_hazard_ratio_pfs, get_hazard_ratio_os
+
+    if exact:
+        lt = solve_trial(**params)
+        return lt, get_hazard_ratio_pfs(lt), get_hazard_ratio_os(lt)
+
+    return get_trial_results(**params, stable=stable, engine=ENGINE)
+
+
+def get_recorded_results(params, exact, stable):
+    """
+    Results of get_simulation_results with the records of the stages they took
+    """
+    with record_stages() as records:
+        results = get_simulation_results(params, exact, stable)
+
+    return results, records
+
+
+@ui.bind_task_button(button_id='btn_refresh')
+@reactive.extended_task
+async def simulation_task(run, stage, params, exact, stable):
+    # the simulation and the Cox fits run in a worker thread, so that the event loop keeps serving all sessions
+    results, records = await asyncio.to_thread(get_recorded_results, params, exact, stable)
+
+    return run, stage, results, records
+
+
+def get_stages(n):
+    """
+    Participants per arm of the successive simulations of a trial with n participants per arm, the previews first
+    """
+    return [stage for stage in PREVIEW_STAGES if stage < n] + [n]
+
+
+def get_plot_image(data, endpoint):
+    from simulation import get_plot_png
+
+    png = base64.b64encode(get_plot_png(data, endpoint)).decode()
+    return ui.tags.img(src=f'data:image/png;base64,{png}', style='width: 100%; height: 300px; object-fit: contain')
+
+
+def get_diagnostics_table(records):
+    """
+    Stage records with the most recent first, times in milliseconds and allocations in megabytes
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(list(records[::-1]))
+    if df.empty:
+        return df
+
+    df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s').dt.strftime('%H:%M:%S')
+    df['time'] = (df['time'] * 1000).round(1)
+    if 'peak_memory' in df:
+        df['peak_memory'] = (df['peak_memory'] / 1e6).round(2)
+
+    return df.rename(columns={'time': 'time (ms)', 'peak_memory': 'peak memory (MB)'})
+
+
+def get_hazard_ratio_text(hr, preview):
+    text = f'Hazard Ratio: {round(hr, 2)}'
+    if preview is not None:
+        text += f' (preview with {preview:,} participants per arm, refining...)'
+
+    return text
+
+
+@reactive.Effect
+def start_prewarm():
+    # the page has been served once a session starts, so the simulation stack can be loaded while the inputs settle
+    prewarm_simulation()
+
+
+# the current simulation, numbered so that results of superseded ones can be told apart, and the results of its last
+# finished stage; reactive values are named explicitly, inferring the name from the call stack slows down every session
+simulation_run = reactive.Value(None, name='simulation_run')
+stage_results = reactive.Value(None, name='stage_results')
+# the exception a stage of the current simulation failed with, shown by every output in place of its results
+simulation_error = reactive.Value(None, name='simulation_error')
+
+# records of the stages measured for this session, see measure_stage
+stage_records = reactive.Value((), name='stage_records')
+
+
+def add_stage_records(records):
+    if records:
+        with reactive.isolate():
+            stage_records.set((stage_records() + tuple(records))[-DIAGNOSTICS_SIZE:])
+
+
+@contextmanager
+def measure_render(output):
+    """
+    Measures the code of a render function as a 'render' stage and adds the records of all stages it took to the
+    diagnostics of the session
+    """
+    with record_stages() as records:
+        with measure_stage('render', output=output):
+            yield
+
+    add_stage_records(records)
+
+
+def start_stage(stage):
+    run = simulation_run()
+    simulation_task(run['id'], stage, {**run['params'], 'n': run['stages'][stage]}, run['exact'], run['stable'])
+
+
+@reactive.Effect
+def start_simulation():
+    click=input.btn_refresh(),
+
+    params = simulation_params()
+    exact = input.exact_setting()
+
+    with reactive.isolate():
+        run_id = simulation_run()['id'] + 1 if simulation_run() else 0
+
+    # a run whose inputs changed in the meantime is cancelled: a run still waiting for a thread does not start, the
+    # result of one already running is discarded
+    simulation_task.cancel()
+    simulation_run.set({
+        'id': run_id,
+        'params': params,
+        'exact': exact,
+        'stable': input.stable_setting(),
+        'stages': [params['n']] if exact else get_stages(params['n']),
+    })
+    stage_results.set(None)
+    simulation_error.set(None)
+
+    with reactive.isolate():
+        start_stage(0)
+
+
+@reactive.Effect
+def refine_simulation():
+    if simulation_task.status() == 'error':
+        # a failed stage ends the simulation, the outputs would otherwise wait for its results forever
+        with reactive.isolate():
+            try:
+                simulation_task.result()
+            except Exception as error:
+                logger.exception('Simulation failed')
+                simulation_error.set(error)
+        return
+
+    if simulation_task.status() != 'success':
+        return
+
+    with reactive.isolate():
+        run_id, stage, results, records = simulation_task.result()
+        add_stage_records(records)
+
+        run = simulation_run()
+        if run_id != run['id']:
+            return
+
+        final = stage == len(run['stages']) - 1
+        stage_results.set((*results, None if final else run['stages'][stage]))
+
+        if not final:
+            start_stage(stage + 1)
+
+
+@reactive.Calc
+def simulation_results():
+    # until the first stage of a simulation finished the outputs are shown as busy, later stages replace the preview
+    if simulation_error() is not None:
+        raise simulation_error()
 
+    if stage_results() is None:
+        raise SilentOperationInProgressException()
 
+    return stage_results()
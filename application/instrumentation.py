@@ -0,0 +1,122 @@
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+# opt-in instrumentation of the simulation, analysis and plotting stages: '' is off, 'time' records the wall time of
+# every stage and 'memory' also its peak traced allocation, which slows allocations down considerably
+INSTRUMENTATION_LEVELS = ['', 'time', 'memory']
+INSTRUMENTATION = os.environ.get('TRIAL_INSTRUMENTATION', '')
+
+# every stage record is logged as a JSON line at level INFO
+logger = logging.getLogger('trial_simulator')
+
+
+class StageContext(threading.local):
+    """
+    Stages running in the current thread and the lists collecting their records, see measure_stage and record_stages
+    """
+    def __init__(self):
+        self.running = []
+        self.collectors = []
+
+
+stage_context = StageContext()
+
+
+@contextmanager
+def measure_stage(stage, **fields):
+    """
+    Records the code run in the context as a stage with the given fields (e.g. n): its wall time in seconds and, with
+    INSTRUMENTATION 'memory', the peak traced allocation in bytes above the allocation at its start. The record is
+    yielded, so that fields known only later can be added, and on exit it is logged and appended to the lists of
+    record_stages in the same thread. Nested stages are recorded separately and count towards the peak of the
+    enclosing one. tracemalloc traces all threads, so the peaks of stages running concurrently overlap.
+    Does nothing while INSTRUMENTATION is off.
+    """
+    if not INSTRUMENTATION:
+        yield {}
+        return
+
+    if INSTRUMENTATION not in INSTRUMENTATION_LEVELS:
+        raise ValueError(f'Unknown instrumentation {INSTRUMENTATION!r}, expected one of {INSTRUMENTATION_LEVELS}')
+
+    running = stage_context.running
+    record = {'stage': stage, **fields, 'timestamp': time.time()}
+
+    frame = None
+    if INSTRUMENTATION == 'memory':
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        current, peak = tracemalloc.get_traced_memory()
+        # the peak is reset for this stage, so the enclosing stage keeps the peak it reached so far
+        if running and running[-1] is not None:
+            running[-1]['peak'] = max(running[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        frame = {'start': current, 'peak': current}
+
+    running.append(frame)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as error:
+        record['error'] = type(error).__name__
+        raise
+    finally:
+        record['time'] = time.perf_counter() - start
+        running.pop()
+
+        if frame is not None:
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            record['peak_memory'] = peak - frame['start']
+            if running and running[-1] is not None:
+                running[-1]['peak'] = max(running[-1]['peak'], peak)
+
+        for records in stage_context.collectors:
+            records.append(record)
+        logger.info(json.dumps(record))
+
+
+@contextmanager
+def record_stages():
+    """
+    Collects the records of all stages measured in the current thread within the context in the yielded list
+    """
+    records = []
+    stage_context.collectors.append(records)
+    try:
+        yield records
+    finally:
+        stage_context.collectors.pop()
+
+
+def instrument(stage, arguments=(), get_fields=None):
+    """
+    Decorator measuring every call of the decorated function as a stage, see measure_stage. The values of the named
+    arguments are recorded as fields, as well as the fields returned by get_fields for all bound arguments.
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENTATION:
+                return function(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            fields = {name: bound.arguments[name] for name in arguments}
+            if get_fields is not None:
+                fields.update(get_fields(bound.arguments))
+
+            with measure_stage(stage, **fields):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
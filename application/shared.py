@@ -0,0 +1,26 @@
+import threading
+from importlib import import_module
+
+from instrumentation import measure_stage
+
+# state shared by all sessions: shiny express executes app.py once per session, imported modules are only loaded once
+
+# the simulation module imports numpy, pandas, scipy and matplotlib, which takes longer than serving the page, so app.py
+# only imports it on first use or once it is pre-warmed by a background thread
+prewarm_thread = None
+
+
+def import_simulation():
+    with measure_stage('import', module='simulation'):
+        import_module('simulation')
+
+
+def prewarm_simulation():
+    """
+    Imports the simulation module in a background thread, once per process. A simulation started in the meantime waits
+    for the import to finish.
+    """
+    global prewarm_thread
+    if prewarm_thread is None:
+        prewarm_thread = threading.Thread(target=import_simulation, name='prewarm_simulation', daemon=True)
+        prewarm_thread.start()
@@ -0,0 +1,988 @@
+import hashlib
+import io
+import json
+import os
+import random
+import uuid
+from collections import OrderedDict
+
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
+import pandas as pd
+from scipy.special import digamma, ndtr, ndtri, polygamma
+
+from instrumentation import instrument, logger, measure_stage
+
+NO_PROGRESSION = 'no progression'
+PROGRESSED = 'progressed'
+CENSORED = 'censored'
+DEAD = 'dead'
+
+# integer codes of the states used by the vectorized engine are the positions in this list
+STATES = [NO_PROGRESSION, PROGRESSED, CENSORED, DEAD]
+
+ENGINES = ['study', 'numpy', 'direct', 'cohort']
+
+# engines that simulate every participant
+PARTICIPANT_ENGINES = ['study', 'numpy', 'direct']
+
+# bump the version of an engine whenever its output for a given seed changes, so that cached trials are not reused
+ENGINE_VERSIONS = {'study': 2, 'numpy': 2, 'direct': 2, 'cohort': 1}
+
+# on-disk cache of simulated trials, shared by the application and the examples
+CACHE_DIR = os.environ.get('TRIAL_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'oncology-trial-simulator'))
+CACHE_SIZE_LIMIT = int(os.environ.get('TRIAL_CACHE_SIZE_LIMIT', 1024 ** 3))
+
+# tie handling of the Cox fit
+TIES = ['efron', 'breslow']
+
+# implementations of the Cox fit in get_hr
+BACKENDS = ['native', 'lifelines']
+
+# size in inches and resolution of the plots encoded by get_plot_png, and the number of encoded plots kept in memory
+PLOT_SIZE = (4, 3)
+PLOT_DPI = 150
+PLOT_CACHE_SIZE = 256
+PLOT_CACHE = OrderedDict()
+
+
+def get_participant_count(data, weights_col=None):
+    """
+    Number of participants in a simulated trial in any format, or in weighted rows with weights_col
+    """
+    if is_life_table(data):
+        return int(data.loc[data['time'] == data['time'].min(), 'at_risk_os'].sum())
+
+    if weights_col is not None:
+        return int(data[weights_col].sum())
+
+    return len(data)
+
+
+def get_data_fields(arguments):
+    return {'n': get_participant_count(arguments['data'], arguments.get('weights_col'))}
+
+
+class StudyParticipant:
+    """
+    Class representing a participant in a clinical trial
+    """
+    def __init__(self):
+        self.progress_time = None
+        self.death_time = None
+        self.censor_time = None
+        self.state = NO_PROGRESSION
+    
+    def update_state(self, state, t):
+        self.state = state
+        if state == PROGRESSED:
+            self.progress(t)
+        elif state == CENSORED:
+            self.censor(t)
+        elif state == DEAD:
+            self.die(t)
+
+    def progress(self, t):
+        self.progress_time = t
+
+    def die(self, t):
+        self.death_time = t
+
+    def censor(self, t):
+        self.censor_time = t
+
+
+class Study:
+    """
+    Class representing a clinical trial
+    """
+
+    def __init__(
+            self, n, duration,
+            p_progression_treatment, p_death_treatment, p_censor_treatment,  p_death_given_progression_treatment, p_death_given_censor_treatment,
+            p_progression_control, p_death_control, p_censor_control, p_death_given_progression_control, p_death_given_censor_control
+            ):
+        self.t = 0
+        self.duration = duration
+        self.p_progression_t = p_progression_treatment
+        self.p_death_t = p_death_treatment
+        self.p_censor_t = p_censor_treatment
+        self.p_death_given_progression_t = p_death_given_progression_treatment
+        self.p_death_given_censor_t = p_death_given_censor_treatment
+        self.p_progression_c = p_progression_control
+        self.p_death_c = p_death_control
+        self.p_censor_c = p_censor_control
+        self.p_death_given_progression_c = p_death_given_progression_control
+        self.p_death_given_censor_c = p_death_given_censor_control
+
+        self.treatment_group = [StudyParticipant() for x in range(n)]
+        self.control_group = [StudyParticipant() for x in range(n)]
+        self.complete = False
+
+    def get_treatment_group(self):
+        return self.treatment_group
+    
+    def get_control_group(self):
+        return self.control_group
+    
+    def check_complete(self):
+        if self.t >= self.duration:
+            return True
+
+        for participant in self.treatment_group + self.control_group:
+            if not participant.death_time:
+                return False
+
+        return True
+
+    def simulate_period(self):
+        self.t += 1
+
+        def draw_events(t, participant, p_p, p_d, p_c, p_d_g_p, p_d_g_c):
+
+            if participant.death_time:
+                return
+            
+            if participant.censor_time: 
+                state = random.choices([DEAD, CENSORED], weights = [p_d_g_c, 1-p_d_g_c], k=1)[0]
+
+            elif participant.progress_time:
+                state = random.choices([DEAD, PROGRESSED], weights = [p_d_g_p, 1-p_d_g_p], k=1)[0]
+
+            else:
+                state = random.choices([DEAD, PROGRESSED, CENSORED, NO_PROGRESSION], weights = [p_d, p_p, p_c, 1-p_d-p_p-p_c], k=1)[0]
+
+            if state != participant.state:
+                participant.update_state(state, t)
+            
+        for participant in self.treatment_group:
+            draw_events(self.t, participant, self.p_progression_t, self.p_death_t, self.p_censor_t, self.p_death_given_progression_t, self.p_death_given_censor_t)
+        
+        for participant in self.control_group:
+            draw_events(self.t, participant, self.p_progression_c, self.p_death_c, self.p_censor_c, self.p_death_given_progression_c, self.p_death_given_censor_c)
+
+        self.complete = self.check_complete()
+
+
+def get_transition_matrix(p_progression, p_death, p_censor, p_death_given_progression, p_death_given_censor):
+    """
+    Per-period transition probabilities between STATES, rows are the current and columns the next state
+    """
+    return np.array([
+        [1 - p_progression - p_death - p_censor, p_progression, p_censor, p_death],
+        [0, 1 - p_death_given_progression, 0, p_death_given_progression],
+        [0, 0, 1 - p_death_given_censor, p_death_given_censor],
+        [0, 0, 0, 1],
+    ])
+
+
+class StudyArm:
+    """
+    Class representing one arm of a clinical trial as integer-coded NumPy arrays (time 0 means no event)
+    """
+    def __init__(self, n):
+        self.state = np.zeros(n, dtype=np.int8)
+        self.progress_time = np.zeros(n, dtype=np.int32)
+        self.death_time = np.zeros(n, dtype=np.int32)
+        self.censor_time = np.zeros(n, dtype=np.int32)
+
+    def draw_events(self, t, cumulative_transitions, rng):
+        alive = np.flatnonzero(self.state != STATES.index(DEAD))
+        state = self.state[alive]
+
+        # one uniform draw per participant, the next state is the number of cumulative probabilities in its row at or below the draw
+        u = rng.random(alive.size)
+        next_state = np.zeros(alive.size, dtype=np.int8)
+        for cumulative_probability in cumulative_transitions.T[:-1]:
+            next_state += u >= cumulative_probability[state]
+
+        changed = next_state != state
+        alive, next_state = alive[changed], next_state[changed]
+        self.state[alive] = next_state
+
+        self.progress_time[alive[next_state == STATES.index(PROGRESSED)]] = t
+        self.censor_time[alive[next_state == STATES.index(CENSORED)]] = t
+        self.death_time[alive[next_state == STATES.index(DEAD)]] = t
+
+
+class VectorizedStudy:
+    """
+    Class representing a clinical trial, drawing the transitions of a whole arm in one batched call per period
+    """
+
+    def __init__(
+            self, n, duration,
+            p_progression_treatment, p_death_treatment, p_censor_treatment,  p_death_given_progression_treatment, p_death_given_censor_treatment,
+            p_progression_control, p_death_control, p_censor_control, p_death_given_progression_control, p_death_given_censor_control,
+            rng=None
+            ):
+        self.t = 0
+        self.duration = duration
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+        self.cumulative_transitions_t = np.cumsum(get_transition_matrix(
+            p_progression_treatment, p_death_treatment, p_censor_treatment, p_death_given_progression_treatment, p_death_given_censor_treatment
+        ), axis=1)
+        self.cumulative_transitions_c = np.cumsum(get_transition_matrix(
+            p_progression_control, p_death_control, p_censor_control, p_death_given_progression_control, p_death_given_censor_control
+        ), axis=1)
+        # guard against rows summing to slightly less than one due to floating point error
+        self.cumulative_transitions_t[:, -1] = 1
+        self.cumulative_transitions_c[:, -1] = 1
+
+        self.treatment_group = StudyArm(n)
+        self.control_group = StudyArm(n)
+        self.complete = False
+
+    def get_treatment_group(self):
+        return self.treatment_group
+
+    def get_control_group(self):
+        return self.control_group
+
+    def check_complete(self):
+        if self.t >= self.duration:
+            return True
+
+        dead = STATES.index(DEAD)
+        return bool((self.treatment_group.state == dead).all() and (self.control_group.state == dead).all())
+
+    def simulate_period(self):
+        self.t += 1
+
+        self.treatment_group.draw_events(self.t, self.cumulative_transitions_t, self.rng)
+        self.control_group.draw_events(self.t, self.cumulative_transitions_c, self.rng)
+
+        self.complete = self.check_complete()
+
+
+def draw_waiting_times(p, size, rng):
+    """
+    Number of periods until a state with constant per-period exit probability p is left (never if p is zero)
+    """
+    if p <= 0:
+        return np.full(size, np.iinfo(np.int64).max)
+
+    return rng.geometric(p, size=size)
+
+
+def sample_arm(n, duration, p_progression, p_death, p_censor, p_death_given_progression, p_death_given_censor, rng):
+    """
+    Draws the complete path of every participant in an arm without stepping through the periods: a geometric time to
+    leave 'no progression', a categorical draw of the next state and a geometric time from 'progressed' or 'censored' to death.
+    Events after the end of the trial are truncated.
+    """
+    arm = StudyArm(n)
+
+    p_exit = p_progression + p_death + p_censor
+    exit_time = draw_waiting_times(p_exit, n, rng)
+    exited = np.flatnonzero(exit_time <= duration)
+    exit_time = exit_time[exited]
+
+    u = rng.random(exited.size) * p_exit
+    next_state = np.where(u < p_progression, STATES.index(PROGRESSED), np.where(u < p_progression + p_censor, STATES.index(CENSORED), STATES.index(DEAD)))
+    arm.state[exited] = next_state
+
+    for state, p_death_given_state, state_time in [
+        (PROGRESSED, p_death_given_progression, arm.progress_time),
+        (CENSORED, p_death_given_censor, arm.censor_time),
+    ]:
+        in_state = next_state == STATES.index(state)
+        participants, entry_time = exited[in_state], exit_time[in_state]
+        state_time[participants] = entry_time
+
+        # compared before adding, the waiting time of a zero death probability would overflow
+        waiting_time = draw_waiting_times(p_death_given_state, participants.size, rng)
+        died = waiting_time <= duration - entry_time
+        arm.state[participants[died]] = STATES.index(DEAD)
+        arm.death_time[participants[died]] = entry_time[died] + waiting_time[died]
+
+    died_without_progression = next_state == STATES.index(DEAD)
+    arm.death_time[exited[died_without_progression]] = exit_time[died_without_progression]
+
+    return arm
+
+
+class TrialData:
+    """
+    Class representing the participants of a simulated trial in compact columns: event times in the smallest unsigned
+    integer type holding the duration (time 0 means no event) and a boolean arm indicator, with the treatment arm first.
+    Participant ids and the data frame are only built on request.
+    """
+    def __init__(self, treated, progress_time, death_time, censor_time, duration):
+        time_type = np.min_scalar_type(duration)
+
+        self.duration = duration
+        self.treated = np.asarray(treated, dtype=bool)
+        self.progress_time = np.asarray(progress_time).astype(time_type, copy=False)
+        self.death_time = np.asarray(death_time).astype(time_type, copy=False)
+        self.censor_time = np.asarray(censor_time).astype(time_type, copy=False)
+
+    @classmethod
+    def from_arms(cls, treatment_group, control_group, duration):
+        def concatenate(times_treatment, times_control):
+            return np.concatenate([times_treatment, times_control], dtype=np.min_scalar_type(duration), casting='unsafe')
+
+        return cls(
+            np.repeat([True, False], [treatment_group.state.size, control_group.state.size]),
+            concatenate(treatment_group.progress_time, control_group.progress_time),
+            concatenate(treatment_group.death_time, control_group.death_time),
+            concatenate(treatment_group.censor_time, control_group.censor_time),
+            duration,
+        )
+
+    def __len__(self):
+        return self.treated.size
+
+    def get_participant_ids(self):
+        n_treatment = int(self.treated.sum())
+        return [f't_{id}' for id in range(n_treatment)] + [f'c_{id}' for id in range(len(self) - n_treatment)]
+
+    def get_endpoint(self, endpoint):
+        """
+        Time of the event or of the end of follow-up and whether an event occurred for every participant, for the
+        endpoint 'pfs' or 'os'
+        """
+        if endpoint == 'pfs':
+            # censoring ends the follow-up of PFS before any later progression or death
+            event_time = np.where(self.censor_time > 0, self.censor_time, np.where(self.progress_time > 0, self.progress_time, self.death_time))
+            has_event = (self.censor_time == 0) & (event_time > 0)
+        else:
+            event_time = self.death_time
+            has_event = event_time > 0
+
+        return np.where(event_time > 0, event_time, self.duration), has_event
+
+    def get_weighted_events(self, endpoint):
+        """
+        Rows of (time, event, group, weight) with the number of participants per distinct combination, like
+        get_weighted_events of a life table
+        """
+        event_time, has_event = self.get_endpoint(endpoint)
+
+        # event times are small integers, so the combinations can be counted with a single bincount
+        counts = np.bincount((self.treated * 2 + has_event) * (self.duration + 1) + event_time, minlength=4 * (self.duration + 1))
+        combinations = np.flatnonzero(counts)
+        group_event, time = np.divmod(combinations, self.duration + 1)
+
+        return pd.DataFrame({'time': time, 'event': group_event % 2, 'group': group_event // 2, 'weight': counts[combinations]})
+
+    @instrument('frame', get_fields=lambda arguments: {'n': len(arguments['self'])})
+    def to_frame(self):
+        """
+        One row per participant with the columns returned by simulate_trial
+        """
+        def as_times(times):
+            return np.where(times > 0, times, np.nan)
+
+        df = pd.DataFrame({
+            'participant': self.get_participant_ids(),
+            'group': self.treated.astype(int),
+            't_progression': as_times(self.progress_time),
+            't_death': as_times(self.death_time),
+            't_censor': as_times(self.censor_time),
+            'duration': self.duration,
+        })
+
+        for endpoint in ['pfs', 'os']:
+            event_time, has_event = self.get_endpoint(endpoint)
+            df[f'{endpoint}_event_time'] = event_time.astype(float)
+            df[f'has_{endpoint}_event'] = has_event.astype(int)
+
+        return df
+
+
+def get_study_arm(participants):
+    """
+    StudyArm with the states and event times of a list of StudyParticipant
+    """
+    arm = StudyArm(len(participants))
+    arm.state[:] = [STATES.index(participant.state) for participant in participants]
+    arm.progress_time[:] = [participant.progress_time or 0 for participant in participants]
+    arm.death_time[:] = [participant.death_time or 0 for participant in participants]
+    arm.censor_time[:] = [participant.censor_time or 0 for participant in participants]
+
+    return arm
+
+
+def simulate_trial(n, duration, stable, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, engine='study'):
+    """
+    Simulates a trial with n participants per arm. Returns one row per participant, except for the 'cohort' engine which
+    only tracks the number of participants per state and returns a life table with one row per arm and period.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown engine {engine!r}, expected one of {ENGINES}')
+
+    if engine == 'cohort':
+        with measure_stage('simulate', n=n, duration=duration, engine=engine):
+            rng = np.random.default_rng(42 if stable else None)
+            return get_trial_life_table(
+                simulate_cohort_arm(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, rng),
+                simulate_cohort_arm(n, duration, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, rng),
+            )
+
+    return simulate_trial_data(n, duration, stable, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, engine=engine).to_frame()
+
+
+@instrument('simulate', arguments=['n', 'duration', 'engine'])
+def simulate_trial_data(n, duration, stable, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, engine='study'):
+    """
+    Simulates a trial with n participants per arm with one of the engines in PARTICIPANT_ENGINES and returns its
+    participants as TrialData
+    """
+    if engine not in PARTICIPANT_ENGINES:
+        raise ValueError(f'Unknown engine {engine!r}, expected one of {PARTICIPANT_ENGINES}')
+
+    study_args = dict(
+        n=n,
+        duration=duration,
+        p_progression_treatment=p_progression_t,
+        p_death_treatment=p_death_t,
+        p_censor_treatment=p_censor_t,
+        p_death_given_progression_treatment=p_death_given_progression_t,
+        p_death_given_censor_treatment=p_death_given_censor_t,
+        p_progression_control=p_progression_c,
+        p_death_control=p_death_c,
+        p_censor_control=p_censor_c,
+        p_death_given_progression_control=p_death_given_progression_c,
+        p_death_given_censor_control = p_death_given_censor_c
+    )
+
+    if engine == 'direct':
+        rng = np.random.default_rng(42 if stable else None)
+        treatment_group = sample_arm(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, rng)
+        control_group = sample_arm(n, duration, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, rng)
+    else:
+        if engine == 'numpy':
+            study = VectorizedStudy(**study_args, rng=np.random.default_rng(42 if stable else None))
+        else:
+            study = Study(**study_args)
+            if stable:
+                random.seed(42)
+
+        while not study.complete:
+            study.simulate_period()
+
+        treatment_group, control_group = study.get_treatment_group(), study.get_control_group()
+        if engine == 'study':
+            treatment_group, control_group = get_study_arm(treatment_group), get_study_arm(control_group)
+
+    return TrialData.from_arms(treatment_group, control_group, duration)
+
+def get_survival(at_risk, events):
+    """
+    Kaplan-Meier survival at the end of each period from the numbers at risk and the events per period, batched over
+    the leading dimensions
+    """
+    hazard = np.divide(events, at_risk, out=np.zeros(np.shape(events)), where=np.asarray(at_risk) > 0)
+    return np.cumprod(1 - hazard, axis=-1)
+
+
+def get_greenwood_band(at_risk, events, survival, alpha=0.05):
+    """
+    Pointwise confidence band at level 1 - alpha of Kaplan-Meier survival from Greenwood's variance, computed on the
+    log(-log) scale like lifelines' KaplanMeierFitter
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # periods in which everybody at risk has an event add no variance
+        variance = np.cumsum(np.nan_to_num(events / (at_risk * (at_risk - events)), posinf=0), axis=-1)
+
+        log_survival = np.log(survival)
+        z = ndtri(1 - alpha / 2)
+        lower = np.exp(-np.exp(np.log(-log_survival) - z * np.sqrt(variance) / log_survival))
+        upper = np.exp(-np.exp(np.log(-log_survival) + z * np.sqrt(variance) / log_survival))
+
+    # the band is undefined while survival is still 1
+    return np.nan_to_num(lower, nan=1), np.nan_to_num(upper, nan=1)
+
+
+def get_arm_counts(occupancy, flows):
+    """
+    Numbers at risk, events and censorings per period for both endpoints of an arm, from the number of participants per
+    state at the end of each period (starting with period 0) and the flows between states in each period, flows[t, ..., i, j]
+    going from state i to state j. Any dimensions between time and state (e.g. replicate trials) are kept.
+    """
+    no_progression, progressed, censored, dead = [STATES.index(state) for state in (NO_PROGRESSION, PROGRESSED, CENSORED, DEAD)]
+
+    # at risk are the participants in the respective states at the start of each period
+    at_risk_pfs = occupancy[:-1, ..., no_progression]
+    at_risk_os = occupancy[:-1, ..., :dead].sum(axis=-1)
+
+    events_pfs = flows[..., no_progression, progressed] + flows[..., no_progression, dead]
+    censored_pfs = flows[..., no_progression, censored].copy()
+    events_os = flows[..., :dead, dead].sum(axis=-1)
+    censored_os = np.zeros_like(events_os)
+
+    # participants still at risk at the end of the trial are censored administratively
+    censored_pfs[-1] = at_risk_pfs[-1] - events_pfs[-1]
+    censored_os[-1] = at_risk_os[-1] - events_os[-1]
+
+    return {
+        'at_risk_pfs': at_risk_pfs,
+        'events_pfs': events_pfs,
+        'censored_pfs': censored_pfs,
+        'at_risk_os': at_risk_os,
+        'events_os': events_os,
+        'censored_os': censored_os,
+    }
+
+
+def get_arm_life_table(occupancy, flows):
+    """
+    Life table of an arm from the state occupancy and flows as taken by get_arm_counts
+    """
+    return pd.DataFrame({
+        'time': np.arange(1, len(flows) + 1),
+        **get_arm_counts(occupancy, flows),
+        'no_progression': occupancy[1:, STATES.index(NO_PROGRESSION)],
+        'progressed': occupancy[1:, STATES.index(PROGRESSED)],
+        'censored': occupancy[1:, STATES.index(CENSORED)],
+        'dead': occupancy[1:, STATES.index(DEAD)],
+    })
+
+
+def get_trial_life_table(life_table_treatment, life_table_control):
+    life_tables = []
+    for group, life_table in [(1, life_table_treatment), (0, life_table_control)]:
+        life_table.insert(0, 'group', group)
+        life_table['pfs_survival'] = get_survival(life_table['at_risk_pfs'].values, life_table['events_pfs'].values)
+        life_table['os_survival'] = get_survival(life_table['at_risk_os'].values, life_table['events_os'].values)
+        life_tables.append(life_table)
+
+    return pd.concat(life_tables, ignore_index=True)
+
+
+def solve_arm(n, duration, p_progression, p_death, p_censor, p_death_given_progression, p_death_given_censor):
+    """
+    Expected life table of an arm with n participants, obtained by propagating the distribution over STATES through the
+    transition matrix instead of simulating participants
+    """
+    transitions = get_transition_matrix(p_progression, p_death, p_censor, p_death_given_progression, p_death_given_censor)
+
+    occupancy = np.zeros((duration + 1, len(STATES)))
+    occupancy[0, STATES.index(NO_PROGRESSION)] = n
+    flows = np.zeros((duration, len(STATES), len(STATES)))
+    for t in range(duration):
+        flows[t] = occupancy[t][:, None] * transitions
+        occupancy[t + 1] = flows[t].sum(axis=0)
+
+    return get_arm_life_table(occupancy, flows)
+
+
+def draw_cohort_flows(n, duration, transitions, rng, replicates=None):
+    """
+    Number of participants per state at the end of each period (starting with period 0) and flows between states in each
+    period for a cohort of n participants, drawn from multinomial distributions over the rows of the transition matrix.
+    With replicates, independent cohorts are drawn in one batch along a second axis.
+    """
+    shape = () if replicates is None else (replicates,)
+
+    occupancy = np.zeros((duration + 1,) + shape + (len(STATES),), dtype=np.int64)
+    occupancy[0, ..., STATES.index(NO_PROGRESSION)] = n
+    flows = np.zeros((duration,) + shape + (len(STATES), len(STATES)), dtype=np.int64)
+    for t in range(duration):
+        flows[t] = rng.multinomial(occupancy[t], transitions)
+        occupancy[t + 1] = flows[t].sum(axis=-2)
+
+    return occupancy, flows
+
+
+def simulate_cohort_arm(n, duration, p_progression, p_death, p_censor, p_death_given_progression, p_death_given_censor, rng):
+    """
+    Life table of a simulated arm with n participants, drawing the number of participants moving between STATES in each
+    period from multinomial distributions instead of simulating individual participants
+    """
+    transitions = get_transition_matrix(p_progression, p_death, p_censor, p_death_given_progression, p_death_given_censor)
+
+    return get_arm_life_table(*draw_cohort_flows(n, duration, transitions, rng))
+
+
+@instrument('solve', arguments=['n', 'duration'])
+def solve_trial(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c):
+    """
+    Exact expected outcome of a trial with n participants per arm, i.e. the limit of simulate_trial for large n.
+    Returns a life table with one row per arm and period, including the expected PFS and OS survival curves.
+    """
+    return get_trial_life_table(
+        solve_arm(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t),
+        solve_arm(n, duration, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c),
+    )
+
+
+def is_life_table(data):
+    return isinstance(data, pd.DataFrame) and 'at_risk_pfs' in data.columns
+
+
+def get_weighted_events(life_table, endpoint):
+    """
+    Rows of (time, event, group, weight) with the number of events and censorings per arm and period of a life table
+    """
+    rows = []
+    for event, count_col in [(1, f'events_{endpoint}'), (0, f'censored_{endpoint}')]:
+        rows.append(pd.DataFrame({
+            'time': life_table['time'],
+            'event': event,
+            'group': life_table['group'],
+            'weight': life_table[count_col],
+        }))
+
+    rows = pd.concat(rows, ignore_index=True)
+    return rows[rows['weight'] > 0]
+
+
+@instrument('kaplan_meier', get_fields=get_data_fields)
+def get_kaplan_meier(data, time_col, event_col, group_col, weights_col=None, alpha=None):
+    """
+    Kaplan-Meier curves of group 1 and group 0 with one row per group and distinct time at which the group is still at
+    risk. With alpha, the curves come with a pointwise confidence band at level 1 - alpha, see get_greenwood_band.
+    """
+    if weights_col is None:
+        data, weights_col = aggregate_events(data, time_col, event_col, group_col), 'weight'
+
+    times = np.unique(data[time_col].values)
+    at_risk, events = get_risk_sets(data, time_col, event_col, group_col, weights_col)
+
+    curves = {
+        'group': np.repeat([1, 0], times.size),
+        'time': np.tile(times, 2),
+        'at_risk': at_risk[::-1].ravel(),
+        'events': events[::-1].ravel(),
+        'survival': get_survival(at_risk, events)[::-1].ravel(),
+    }
+    if alpha is not None:
+        lower, upper = get_greenwood_band(at_risk, events, get_survival(at_risk, events), alpha=alpha)
+        curves['survival_lower'] = lower[::-1].ravel()
+        curves['survival_upper'] = upper[::-1].ravel()
+
+    curves = pd.DataFrame(curves)
+    return curves[curves['at_risk'] > 0].reset_index(drop=True)
+
+
+def aggregate_events(data, time_col, event_col, group_col):
+    """
+    Collapses participant rows into one row per distinct (time, event, group) with the number of participants as weight
+    """
+    return data.groupby([time_col, event_col, group_col]).size().rename('weight').reset_index()
+
+
+def get_risk_sets(data, time_col, event_col, group_col, weights_col):
+    """
+    Numbers at risk and events at each distinct time of weighted rows, as arrays of shape (2, times) indexed by group
+    """
+    times, time_index = np.unique(data[time_col].values, return_inverse=True)
+    group = data[group_col].values.astype(int)
+    weight = data[weights_col].values.astype(float)
+    event = data[event_col].values == 1
+
+    leaving = np.zeros((2, times.size))
+    events = np.zeros((2, times.size))
+    np.add.at(leaving, (group, time_index), weight)
+    np.add.at(events, (group[event], time_index[event]), weight[event])
+
+    # everyone with an event or censoring at or after a time is at risk at that time
+    at_risk = np.cumsum(leaving[:, ::-1], axis=1)[:, ::-1]
+
+    return at_risk, events
+
+
+def fit_cox(at_risk, events, ties='efron', tolerance=1e-9, max_iterations=50):
+    """
+    Maximizes the Cox partial likelihood for the binary group covariate by Newton-Raphson, using only the numbers at
+    risk and events per arm at each distinct time. at_risk and events have shape (2, ..., times), indexed by group first;
+    any dimensions in between (e.g. replicate trials) are fitted in one batch.
+
+    With Efron's tie correction the sum over the tied events at each time is expressed with the log-gamma function, so it
+    costs the same for any number of ties and gives the same estimate as a fit on one row per participant.
+    Returns the log hazard ratio of group 1 versus group 0 and its standard error.
+    """
+    if ties not in TIES:
+        raise ValueError(f'Unknown tie handling {ties!r}, expected one of {TIES}')
+
+    (r0, r1), (e0, e1) = np.asarray(at_risk, dtype=float), np.asarray(events, dtype=float)
+    d = e0 + e1
+    k = r1 * e0 - r0 * e1
+
+    beta = np.zeros(d.shape[:-1])
+    for _ in range(max_iterations):
+        w = np.exp(beta)[..., None]
+        r = r0 + r1 * w
+
+        if ties == 'breslow':
+            score = (e1 - d * r1 * w / r).sum(axis=-1)
+            information = (d * r0 * r1 * w / r ** 2).sum(axis=-1)
+        else:
+            # times without events contribute nothing, a tied sum of one keeps their terms finite
+            tied = np.where(d > 0, e0 + e1 * w, 1)
+
+            # Efron: sum over j < d of log(r - j / d * tied) = d * log(tied / d) + lgamma(a + 1) - lgamma(a - d + 1)
+            a = d * r / tied
+            da = d * w * k / tied ** 2
+            dda = d * w * k * (tied - 2 * e1 * w) / tied ** 3
+            digamma_diff = digamma(a + 1) - digamma(a - d + 1)
+            trigamma_diff = polygamma(1, a + 1) - polygamma(1, a - d + 1)
+
+            score = (e1 - d * e1 * w / tied - da * digamma_diff).sum(axis=-1)
+            information = (d * e0 * e1 * w / tied ** 2 + dda * digamma_diff + da ** 2 * trigamma_diff).sum(axis=-1)
+
+        step = np.clip(np.divide(score, information, out=np.zeros_like(beta), where=information > 0), -1, 1)
+        beta = beta + step
+        if np.all(np.abs(step) < tolerance):
+            break
+
+    se = np.divide(1, np.sqrt(information), out=np.full_like(beta, np.inf), where=information > 0)
+
+    return beta, se
+
+
+def estimate_hazard_ratio(at_risk, events, ties='efron', alpha=0.05):
+    """
+    Hazard ratio of group 1 versus group 0 with the standard error of its logarithm, a Wald confidence interval at level
+    1 - alpha and the Wald test p-value, from the numbers at risk and events per arm as taken by fit_cox
+    """
+    log_hr, se = fit_cox(at_risk, events, ties=ties)
+    z = ndtri(1 - alpha / 2)
+
+    return {
+        'hr': np.exp(log_hr),
+        'se': se,
+        'ci_lower': np.exp(log_hr - z * se),
+        'ci_upper': np.exp(log_hr + z * se),
+        'p': 2 * ndtr(-np.abs(log_hr / se)),
+    }
+
+
+def get_hr_estimate(data, time_col, event_col, group_col, weights_col=None, ties='efron', alpha=0.05):
+    if weights_col is None:
+        data, weights_col = aggregate_events(data, time_col, event_col, group_col), 'weight'
+
+    at_risk, events = get_risk_sets(data, time_col, event_col, group_col, weights_col)
+
+    return {key: float(value) for key, value in estimate_hazard_ratio(at_risk, events, ties=ties, alpha=alpha).items()}
+
+
+@instrument('hazard_ratio', arguments=['backend', 'ties'], get_fields=get_data_fields)
+def get_hr(data, time_col, event_col, group_col, weights_col=None, backend='native', ties='efron'):
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown backend {backend!r}, expected one of {BACKENDS}')
+
+        if backend == 'lifelines':
+            from lifelines import CoxPHFitter
+
+            cph = CoxPHFitter()
+            data_fit = data[[time_col, event_col, group_col] + ([weights_col] if weights_col else [])]
+            cph.fit(data_fit, duration_col=time_col, event_col=event_col, weights_col=weights_col)
+            hr = float(cph.hazard_ratios_.iloc[0])
+
+            return hr
+
+        hr = get_hr_estimate(data, time_col, event_col, group_col, weights_col=weights_col, ties=ties)['hr']
+
+        return hr
+
+def get_hazard_ratio_pfs(df, backend='native'):
+    if is_life_table(df):
+        return get_hr(get_weighted_events(df, 'pfs'), 'time', 'event', 'group', weights_col='weight', backend=backend)
+
+    if isinstance(df, TrialData):
+        return get_hr(df.get_weighted_events('pfs'), 'time', 'event', 'group', weights_col='weight', backend=backend)
+
+    hr_pfs = get_hr(df, 'pfs_event_time', 'has_pfs_event', 'group', backend=backend)
+
+    return hr_pfs
+
+def get_hazard_ratio_os(df, backend='native'):
+    if is_life_table(df):
+        return get_hr(get_weighted_events(df, 'os'), 'time', 'event', 'group', weights_col='weight', backend=backend)
+
+    if isinstance(df, TrialData):
+        return get_hr(df.get_weighted_events('os'), 'time', 'event', 'group', weights_col='weight', backend=backend)
+
+    hr_os = get_hr(df, 'os_event_time', 'has_os_event', 'group', backend=backend)
+
+    return hr_os
+
+def get_cache_key(params, engine, seed):
+    """
+    Hash of everything that determines a simulated trial: the 12 simulation parameters, the seed and the engine version
+    """
+    key = json.dumps({'params': params, 'seed': seed, 'engine': engine, 'version': ENGINE_VERSIONS[engine]}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def read_cached_trial(key):
+    path = os.path.join(CACHE_DIR, f'{key}.npz')
+    try:
+        with np.load(path) as cached:
+            arrays = dict(cached)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as error:
+        logger.warning(f'Could not read trial {key} from the cache in {CACHE_DIR}: {error}')
+        return None
+
+    # the modification time tracks the last use for the least recently used eviction; the entry may have been evicted
+    # by another process since it was loaded
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    meta = json.loads(str(arrays.pop('meta')))
+    if meta['kind'] == 'life_table':
+        data = pd.DataFrame(arrays)
+    else:
+        data = TrialData(**arrays, duration=meta['duration'])
+
+    return data, meta['hr_pfs'], meta['hr_os']
+
+
+@instrument('cache_write')
+def write_cached_trial(key, data, hr_pfs, hr_os, duration):
+    meta = {'hr_pfs': hr_pfs, 'hr_os': hr_os, 'duration': duration}
+    if is_life_table(data):
+        meta['kind'] = 'life_table'
+        arrays = {column: data[column].to_numpy() for column in data.columns}
+    else:
+        meta['kind'] = 'participants'
+        arrays = {column: getattr(data, column) for column in ['treated', 'progress_time', 'death_time', 'censor_time']}
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temporary_path = os.path.join(CACHE_DIR, f'{key}.{uuid.uuid4().hex}.tmp.npz')
+    try:
+        np.savez_compressed(temporary_path, meta=json.dumps(meta), **arrays)
+        os.replace(temporary_path, os.path.join(CACHE_DIR, f'{key}.npz'))
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    evict_cache()
+
+
+def evict_cache():
+    """
+    Removes the least recently used entries until the cache is below CACHE_SIZE_LIMIT bytes
+    """
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.npz') and '.tmp' not in entry.name:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    size = sum(entry[1] for entry in entries)
+    for _, entry_size, path in sorted(entries):
+        if size <= CACHE_SIZE_LIMIT:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        size -= entry_size
+
+
+@instrument('trial_results', arguments=['n', 'duration', 'engine'])
+def get_trial_results(n, duration, stable, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, engine='study', cache=True):
+    """
+    Simulated trial with its PFS and OS hazard ratios. The trial is returned as TrialData, or as a life table for the
+    'cohort' engine. Seeded runs are stored in an on-disk cache shared by the application and the examples, and read
+    from there when the same trial was simulated before.
+    """
+    params = dict(
+        n=n, duration=duration,
+        p_progression_t=p_progression_t, p_death_t=p_death_t, p_censor_t=p_censor_t, p_death_given_progression_t=p_death_given_progression_t, p_death_given_censor_t=p_death_given_censor_t,
+        p_progression_c=p_progression_c, p_death_c=p_death_c, p_censor_c=p_censor_c, p_death_given_progression_c=p_death_given_progression_c, p_death_given_censor_c=p_death_given_censor_c
+    )
+    seed = 42 if stable else None
+    cache = cache and seed is not None
+
+    if cache:
+        key = get_cache_key(params, engine, seed)
+        with measure_stage('cache_read') as record:
+            cached = read_cached_trial(key)
+            record['hit'] = cached is not None
+        if cached is not None:
+            return cached
+
+    if engine in PARTICIPANT_ENGINES:
+        data = simulate_trial_data(**params, engine=engine, stable=stable)
+    else:
+        data = simulate_trial(**params, engine=engine, stable=stable)
+    hr_pfs = get_hazard_ratio_pfs(data)
+    hr_os = get_hazard_ratio_os(data)
+
+    if cache:
+        # the cache only saves time, a trial that cannot be stored is still returned
+        try:
+            write_cached_trial(key, data, hr_pfs, hr_os, duration)
+        except OSError as error:
+            logger.warning(f'Could not write trial {key} to the cache in {CACHE_DIR}: {error}')
+
+    return data, hr_pfs, hr_os
+
+
+def get_curves(data, endpoint):
+    """
+    Survival curves of an endpoint of a simulated trial in any format, one row per group and time with a 'survival' column
+    """
+    if is_life_table(data):
+        return data[['group', 'time', f'{endpoint}_survival']].rename(columns={f'{endpoint}_survival': 'survival'})
+
+    if isinstance(data, TrialData):
+        return get_kaplan_meier(data.get_weighted_events(endpoint), 'time', 'event', 'group', weights_col='weight')
+
+    return get_kaplan_meier(data, f'{endpoint}_event_time', f'has_{endpoint}_event', 'group')
+
+@instrument('plot_kaplan_meier', get_fields=get_data_fields)
+def plot_kaplan_meier(data, time_col, event_col, group_col, alpha=None, ax=None):
+    plot_survival(get_kaplan_meier(data, time_col, event_col, group_col, alpha=alpha), 'survival', 'group', ax=ax)
+
+@instrument('plot')
+def plot_survival(data, survival_col, group_col, ax=None):
+    ax = ax if ax is not None else plt.gca()
+
+    for group, label in [(1, 'Treated'), (0, 'Control')]:
+        data_group = data[data[group_col] == group]
+        times = np.append(0, data_group['time'])
+        line, = ax.plot(times, np.append(1, data_group[survival_col]), drawstyle='steps-post', label=label)
+
+        if f'{survival_col}_lower' in data:
+            lower, upper = np.append(1, data_group[f'{survival_col}_lower']), np.append(1, data_group[f'{survival_col}_upper'])
+            ax.fill_between(times, lower, upper, step='post', color=line.get_color(), alpha=0.25, linewidth=0)
+
+    ax.set_xlabel('timeline')
+    ax.legend()
+
+def plot_endpoint(data, endpoint, ax=None):
+    plot_survival(get_curves(data, endpoint), 'survival', 'group', ax=ax)
+
+def get_plot_png(data, endpoint, figsize=PLOT_SIZE, dpi=PLOT_DPI):
+    """
+    Plot of the survival curves of an endpoint encoded as PNG. The figure is drawn with the Agg backend outside of
+    pyplot, so it is never registered globally and is freed once rendered. Encoded plots are cached by their curves and
+    options, the PLOT_CACHE_SIZE least recently used are kept.
+    """
+    with measure_stage('plot_png', endpoint=endpoint, n=get_participant_count(data)) as record:
+        curves = get_curves(data, endpoint)
+        key = hashlib.sha256(pd.util.hash_pandas_object(curves, index=False).values.tobytes() + repr((figsize, dpi)).encode()).hexdigest()
+
+        record['cached'] = key in PLOT_CACHE
+        if key in PLOT_CACHE:
+            PLOT_CACHE.move_to_end(key)
+            return PLOT_CACHE[key]
+
+        figure = Figure(figsize=figsize, dpi=dpi)
+        plot_survival(curves, 'survival', 'group', ax=figure.subplots())
+
+        buffer = io.BytesIO()
+        FigureCanvasAgg(figure).print_png(buffer)
+        png = buffer.getvalue()
+
+    PLOT_CACHE[key] = png
+    while len(PLOT_CACHE) > PLOT_CACHE_SIZE:
+        PLOT_CACHE.popitem(last=False)
+
+    return png
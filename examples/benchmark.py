@@ -0,0 +1,268 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+from datetime import datetime, timezone
+from itertools import product
+
+import numpy as np
+import pandas as pd
+import websockets
+
+import simulation
+from settings import settings, N as EXAMPLE_N, DURATION as EXAMPLE_DURATION
+from simulation import (
+    ENGINES, simulate_trial, get_trial_results, get_hazard_ratio_pfs, get_hazard_ratio_os, get_curves, get_plot, get_plot_png,
+)
+
+path = os.path.dirname(__file__)
+
+# matrix of trial sizes (participants per arm) and durations (periods) every stage is measured at
+N_VALUES = [10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+DURATIONS = [5, 20, 50, 200]
+QUICK_N_VALUES = [10 ** 2, 10 ** 3, 10 ** 4]
+QUICK_DURATIONS = [20]
+
+# the original Study engine steps through every participant in Python, larger trials would take hours
+STUDY_MAX_N = 10 ** 4
+
+# a stage is repeated until it took this many seconds in total or ran MAX_REPEATS times, its fastest run is reported
+MIN_TOTAL_TIME = 1.0
+MAX_REPEATS = 10
+
+# relative increase of the time or the peak allocation over the baseline above which a result is a regression, timings
+# of repeated runs on a shared machine easily vary by a few tens of percent
+THRESHOLD = 0.5
+
+# absolute slack, so that noise in stages of a few milliseconds or in matplotlib's internal caches is not reported
+MIN_TIME_DIFFERENCE = 0.005
+MIN_MEMORY_DIFFERENCE = 1e6
+
+# the Shiny application is launched this many times in a new process, its fastest start is reported
+APP_PATH = os.path.join(path, '..', 'application')
+APP_STARTS = 3
+
+# inputs sent by a browser opening the application with its default settings
+APP_INPUTS = {
+    'p_progression_treatment': 0.05, 'p_progression_control': 0.05,
+    'p_death_treatment': 0.05, 'p_death_control': 0.05,
+    'p_death_given_progression_treatment': 0.1, 'p_death_given_progression_control': 0.1,
+    'p_censor_treatment': 0, 'p_censor_control': 0,
+    'p_death_given_censor_treatment': 0.05, 'p_death_given_censor_control': 0.05,
+    'stable_setting': True, 'show_censoring': False, 'exact_setting': False,
+    'n': 10000, 'duration': 20, 'btn_refresh:shiny.action': 0,
+    '.clientdata_output_hazard_ratio_pfs_hidden': False,
+}
+
+BASELINE_PATH = os.path.join(path, 'benchmarks', 'baseline.json')
+SEED = 42
+
+KEY = ['stage', 'engine', 'setting', 'n', 'duration']
+
+
+def measure(function):
+    """
+    Fastest wall time over the repeats and peak traced allocation of one further run of function, in seconds and bytes
+    """
+    times = []
+    while len(times) < MAX_REPEATS and sum(times) < MIN_TOTAL_TIME:
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    # tracing slows allocations down, so the peak is taken from a separate run
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(times), peak
+
+
+def render_plot(data):
+    # a miss of the PNG cache is measured, so the cache is emptied first
+    simulation.PLOT_CACHE.clear()
+    get_plot_png(data, 'pfs')
+    get_plot_png(data, 'os')
+
+
+def run_example(engine):
+    """
+    The simulations, hazard ratios and plots of example_simulations.py, without writing the plots
+    """
+    for params in settings.values():
+        df_trial, hazard_ratio_pfs, hazard_ratio_os = get_trial_results(**params, engine=engine, seed=SEED, cache=False)
+        get_plot(df_trial, hazard_ratio_pfs, hazard_ratio_os).savefig(io.BytesIO())
+
+
+async def wait_for_first_result(port):
+    async with websockets.connect(f'ws://127.0.0.1:{port}/websocket/', max_size=None) as websocket:
+        await websocket.send(json.dumps({'method': 'init', 'data': APP_INPUTS}))
+        while 'hazard_ratio_pfs' not in json.loads(await websocket.recv()).get('values', {}):
+            pass
+
+
+def start_app():
+    """
+    Seconds from launching the application in a new process with an empty trial cache until its page is served and
+    until a session opened right after shows its first hazard ratio
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'shiny', 'run', '--port', str(port), 'app.py'], cwd=APP_PATH,
+            env={**os.environ, 'TRIAL_CACHE_DIR': cache_dir}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            while True:
+                try:
+                    urllib.request.urlopen(f'http://127.0.0.1:{port}/').read()
+                    break
+                except OSError:
+                    time.sleep(0.01)
+            page = time.perf_counter() - start
+
+            asyncio.run(wait_for_first_result(port))
+            first_result = time.perf_counter() - start
+        finally:
+            process.terminate()
+            process.wait()
+
+    return page, first_result
+
+
+def get_cases(n_values, durations, engines):
+    """
+    Stages with their arguments for every combination of setting, n and duration
+    """
+    for (setting, params), n, duration in product(settings.items(), n_values, durations):
+        params = {**params, 'n': n, 'duration': duration}
+
+        for engine in engines:
+            if engine == 'study' and n > STUDY_MAX_N:
+                continue
+            yield ('simulate', engine, setting, n, duration), lambda params=params, engine=engine: simulate_trial(**params, engine=engine, seed=SEED)
+
+        # the analysis stages use participant-level data, as the examples and the app
+        df_trial = simulate_trial(**params, engine='direct', seed=SEED)
+        yield ('hazard_ratio', 'direct', setting, n, duration), lambda df_trial=df_trial: (get_hazard_ratio_pfs(df_trial), get_hazard_ratio_os(df_trial))
+        yield ('kaplan_meier', 'direct', setting, n, duration), lambda df_trial=df_trial: (get_curves(df_trial, 'pfs'), get_curves(df_trial, 'os'))
+        yield ('plot', 'direct', setting, n, duration), lambda df_trial=df_trial: render_plot(df_trial)
+
+
+def run_benchmarks(n_values, durations, engines, example=True, app=True):
+    rows = []
+    if app:
+        page, first_result = np.min([start_app() for _ in range(APP_STARTS)], axis=0)
+        for stage, seconds in [('app_page', page), ('app_first_result', first_result)]:
+            rows.append({'stage': stage, 'engine': 'numpy', 'setting': 'default', 'n': APP_INPUTS['n'], 'duration': APP_INPUTS['duration'], 'time': seconds, 'peak_memory': None})
+            print(f'{stage:>16} {seconds * 1000:10.2f} ms')
+
+    for (stage, engine, setting, n, duration), function in get_cases(n_values, durations, engines):
+        seconds, peak = measure(function)
+        rows.append({'stage': stage, 'engine': engine, 'setting': setting, 'n': n, 'duration': duration, 'time': seconds, 'peak_memory': peak})
+        print(f'{stage:>12} {engine:>6} {setting:<40} n={n:<8} duration={duration:<4} {seconds * 1000:10.2f} ms {peak / 1e6:10.2f} MB')
+
+    if example:
+        for engine in ['numpy', 'direct']:
+            seconds, peak = measure(lambda engine=engine: run_example(engine))
+            rows.append({'stage': 'example', 'engine': engine, 'setting': 'all', 'n': EXAMPLE_N, 'duration': EXAMPLE_DURATION, 'time': seconds, 'peak_memory': peak})
+            print(f'{"example":>12} {engine:>6} {"all":<40} {seconds * 1000:10.2f} ms {peak / 1e6:10.2f} MB')
+
+    return pd.DataFrame(rows)
+
+
+def get_speedups(df_results):
+    """
+    Time of the Study reference engine divided by the time of every engine, per setting, n and duration
+    """
+    df_simulate = df_results[df_results['stage'] == 'simulate']
+    df_times = df_simulate.pivot_table(index=['setting', 'n', 'duration'], columns='engine', values='time')
+    if 'study' not in df_times:
+        return pd.DataFrame()
+
+    return df_times.rdiv(df_times['study'], axis=0).drop(columns='study').dropna(how='all')
+
+
+def compare_to_baseline(df_results, df_baseline, threshold=THRESHOLD):
+    """
+    Results that are slower or allocate more than the baseline by more than threshold (relative)
+    """
+    df = df_results.merge(df_baseline, on=KEY, suffixes=('', '_baseline'))
+    df['time_ratio'] = df['time'] / df['time_baseline']
+    df['peak_memory_ratio'] = df['peak_memory'] / df['peak_memory_baseline']
+
+    slower = (df['time_ratio'] > 1 + threshold) & (df['time'] - df['time_baseline'] > MIN_TIME_DIFFERENCE)
+    larger = (df['peak_memory_ratio'] > 1 + threshold) & (df['peak_memory'] - df['peak_memory_baseline'] > MIN_MEMORY_DIFFERENCE)
+
+    return df[slower | larger]
+
+
+def read_baseline(baseline_path):
+    with open(baseline_path) as file:
+        return pd.DataFrame(json.load(file)['results'])
+
+
+def write_baseline(df_results, baseline_path):
+    os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+    baseline = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+        },
+        'results': df_results.to_dict(orient='records'),
+    }
+    with open(baseline_path, 'w') as file:
+        json.dump(baseline, file, indent=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times and memory-profiles the simulation, analysis and plotting stages.')
+    parser.add_argument('--quick', action='store_true', help='only small trials of 20 periods')
+    parser.add_argument('--engines', nargs='+', default=ENGINES, choices=ENGINES)
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline results to compare with or to write')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--skip-app', action='store_true', help='do not measure the start of the Shiny application')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='relative increase flagged as a regression')
+    args = parser.parse_args()
+
+    n_values, durations = (QUICK_N_VALUES, QUICK_DURATIONS) if args.quick else (N_VALUES, DURATIONS)
+    df_results = run_benchmarks(n_values, durations, args.engines, example=not args.quick, app=not args.skip_app)
+
+    df_speedups = get_speedups(df_results)
+    if not df_speedups.empty:
+        with pd.option_context('display.width', 200, 'display.max_rows', None, 'display.max_columns', None):
+            print(f'\nSpeedup over the Study engine:\n{df_speedups.round(1)}')
+
+    if args.save_baseline:
+        write_baseline(df_results, args.baseline)
+        print(f'\nSaved baseline to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        df_regressions = compare_to_baseline(df_results, read_baseline(args.baseline), threshold=args.threshold)
+        if df_regressions.empty:
+            print(f'\nNo regressions beyond {args.threshold:.0%} against {args.baseline}')
+        else:
+            with pd.option_context('display.width', 200, 'display.max_rows', None, 'display.max_columns', None):
+                print(f'\nRegressions beyond {args.threshold:.0%} against {args.baseline}:')
+                print(df_regressions[KEY + ['time', 'time_baseline', 'time_ratio', 'peak_memory', 'peak_memory_baseline', 'peak_memory_ratio']])
+            sys.exit(1)
+    else:
+        print(f'\nNo baseline at {args.baseline}, store one with --save-baseline')
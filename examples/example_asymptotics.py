@@ -0,0 +1,30 @@
+import pandas as pd
+
+from settings import settings
+from simulation import simulate_trial_chunked, solve_trial, get_hazard_ratio_pfs, get_hazard_ratio_os
+
+# hazard ratios of very large simulated trials against the exact expected ones, the memory use only depends on the chunk size
+N = 100 * 1000 * 1000
+SEED = 42
+
+rows = []
+
+for setting, params in settings.items():
+    print(f'Processing setting {setting}...')
+
+    params = {**params, 'n': N}
+    lt_simulated = simulate_trial_chunked(**params, seed=SEED)
+    lt_exact = solve_trial(**params)
+
+    rows.append({
+        'setting': setting,
+        'hr_pfs_simulated': get_hazard_ratio_pfs(lt_simulated),
+        'hr_pfs_exact': get_hazard_ratio_pfs(lt_exact),
+        'hr_os_simulated': get_hazard_ratio_os(lt_simulated),
+        'hr_os_exact': get_hazard_ratio_os(lt_exact),
+    })
+
+df_asymptotics = pd.DataFrame(rows).set_index('setting')
+
+with pd.option_context('display.width', 200, 'display.max_columns', None):
+    print(df_asymptotics.round(4))
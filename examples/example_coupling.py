@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+
+from settings import settings
+from simulation import simulate_trial_data, solve_trial, get_hazard_ratio_pfs, get_hazard_ratio_os
+
+# settings of the article that differ in a single parameter, and the precision of the differences of their hazard ratios
+# with independent and with coupled random numbers at a fraction of the article's sample size
+COMPARISONS = [
+    ('1_progression_driven_low_translation', '2_progression_driven_high_translation'),
+    ('5_censoring_driven_treat_low', '6_censoring_driven_treat_high'),
+]
+COUPLINGS = [None, 'common', 'antithetic']
+N = 2500
+REPLICATES = 200
+
+HAZARD_RATIOS = {'pfs': get_hazard_ratio_pfs, 'os': get_hazard_ratio_os}
+
+rows = []
+
+for setting_a, setting_b in COMPARISONS:
+    print(f'Comparing {setting_a} and {setting_b}...')
+
+    exact_a, exact_b = solve_trial(**settings[setting_a]), solve_trial(**settings[setting_b])
+
+    for coupling in COUPLINGS:
+        differences = {endpoint: [] for endpoint in HAZARD_RATIOS}
+        for replicate in range(REPLICATES):
+            # coupled scenarios share the seed, independent ones do not
+            seed_b = replicate if coupling else REPLICATES + replicate
+            data_a = simulate_trial_data(**{**settings[setting_a], 'n': N}, engine='direct', seed=replicate, coupling=coupling)
+            data_b = simulate_trial_data(**{**settings[setting_b], 'n': N}, engine='direct', seed=seed_b, coupling=coupling)
+            for endpoint, get_hazard_ratio in HAZARD_RATIOS.items():
+                differences[endpoint].append(get_hazard_ratio(data_b) - get_hazard_ratio(data_a))
+
+        for endpoint, get_hazard_ratio in HAZARD_RATIOS.items():
+            rows.append({
+                'comparison': f'{setting_a[0]} vs {setting_b[0]}',
+                'endpoint': endpoint,
+                'coupling': coupling or 'independent',
+                'difference_exact': get_hazard_ratio(exact_b) - get_hazard_ratio(exact_a),
+                'difference_mean': np.mean(differences[endpoint]),
+                'difference_std': np.std(differences[endpoint], ddof=1),
+            })
+
+df_coupling = pd.DataFrame(rows)
+
+# the variance of an independent difference falls with 1 / n, so the variance ratio is the factor of participants saved
+independent = df_coupling.groupby(['comparison', 'endpoint'])['difference_std'].transform('first')
+df_coupling['participants_saved'] = (independent / df_coupling['difference_std']) ** 2
+
+with pd.option_context('display.width', 200, 'display.max_columns', None):
+    print(df_coupling.round(4))
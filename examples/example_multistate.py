@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+from settings import settings
+from simulation import MultiStateModel, simulate_model, solve_trial, get_hr, get_hazard_ratio_pfs, get_hazard_ratio_os
+
+# the four-state model of the article as a multi-state model, and an extension with a response to treatment and a
+# second-line therapy after progression that the article's parameters cannot express
+N = 100 * 1000
+SEED = 42
+
+STATES = ['stable', 'response', 'progressed', 'second line', 'censored', 'dead']
+
+
+def get_transitions(p_response, p_death_given_second_line):
+    """
+    Per-period transition probabilities between STATES of an arm, responders progress at a quarter of the rate
+    """
+    return np.array([
+        # stable: response, progression, censoring or death
+        [0.925 - p_response, p_response, 0.025, 0, 0.025, 0.025],
+        [0, 0.9625, 0.00625, 0, 0.00625, 0.025],
+        # progressed: second-line therapy starts after 5 periods on average, or death
+        [0, 0, 0.6625, 0.2, 0, 0.1375],
+        [0, 0, 0, 1 - p_death_given_second_line, 0, p_death_given_second_line],
+        [0, 0, 0, 0, 0.975, 0.025],
+        [0, 0, 0, 0, 0, 1],
+    ])
+
+
+models = {
+    '1_progression_driven_low_translation': MultiStateModel.from_probabilities(**{
+        name: value for name, value in settings['1_progression_driven_low_translation'].items() if name not in ('n', 'duration')
+    }),
+    'response_and_second_line': MultiStateModel(
+        STATES,
+        get_transitions(p_response=0.05, p_death_given_second_line=0.05),
+        get_transitions(p_response=0.01, p_death_given_second_line=0.05),
+        events={'pfs': ['progressed', 'dead'], 'os': ['dead'], 'second_line': ['second line']},
+        censoring={'pfs': ['censored']},
+    ),
+}
+
+rows = []
+
+for name, model in models.items():
+    print(f'Processing model {name}...')
+
+    data = simulate_model(model, N, settings['1_progression_driven_low_translation']['duration'], seed=SEED)
+
+    row = {'model': name}
+    for endpoint in model.events:
+        row[f'hr_{endpoint}'] = get_hr(data.get_weighted_events(endpoint), 'time', 'event', 'group', weights_col='weight')
+    rows.append(row)
+
+df_models = pd.DataFrame(rows).set_index('model')
+
+# the article model gives the same hazard ratios as its exact expected trial up to sampling noise
+lt_exact = solve_trial(**settings['1_progression_driven_low_translation'])
+df_models.loc['1_progression_driven_low_translation (exact)', ['hr_pfs', 'hr_os']] = [get_hazard_ratio_pfs(lt_exact), get_hazard_ratio_os(lt_exact)]
+
+with pd.option_context('display.width', 200, 'display.max_columns', None):
+    print(df_models.round(4))
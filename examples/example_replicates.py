@@ -0,0 +1,22 @@
+import pandas as pd
+
+from settings import settings
+from simulation import simulate_replicates, summarize_replicates
+
+# sampling variability of the hazard ratios at a realistic trial size
+N = 300
+REPLICATES = 10 * 1000
+SEED = 42
+
+summaries = {}
+
+for setting, params in settings.items():
+    print(f'Processing setting {setting}...')
+
+    df_replicates = simulate_replicates(REPLICATES, **{**params, 'n': N}, seed=SEED)
+    summaries[setting] = summarize_replicates(df_replicates)
+
+df_summary = pd.concat(summaries, names=['setting', 'statistic'])
+
+with pd.option_context('display.width', 200, 'display.max_rows', None):
+    print(df_summary.round(3))
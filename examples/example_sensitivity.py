@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+from settings import settings
+from simulation import get_sensitivities, solve_trial, get_hazard_ratio_pfs, get_hazard_ratio_os, SENSITIVITY_STEP, \
+    SENSITIVITY_ABSOLUTE_STEP
+
+# which transition probabilities drive the gap between the PFS and OS hazard ratios in every setting, with the
+# elasticity and derivative of the exact expected trials as a reference
+SEED = 42
+
+
+def get_exact_sensitivity_ratio(params, parameter, step=SENSITIVITY_STEP, absolute_step=SENSITIVITY_ABSOLUTE_STEP):
+    value = params[parameter]
+    values = (value * (1 + step), value * (1 - step)) if value > 0 else (absolute_step, 0)
+
+    log_hr_ratios = []
+    for perturbed in values:
+        lt_exact = solve_trial(**{**params, parameter: perturbed})
+        log_hr_ratios.append(np.log(get_hazard_ratio_pfs(lt_exact) / get_hazard_ratio_os(lt_exact)))
+
+    elasticity = (log_hr_ratios[0] - log_hr_ratios[1]) / (np.log(values[0]) - np.log(values[1])) if value > 0 else np.nan
+    derivative = (np.exp(log_hr_ratios[0]) - np.exp(log_hr_ratios[1])) / (values[0] - values[1])
+
+    return elasticity, derivative
+
+
+sensitivities = {}
+
+for setting, params in settings.items():
+    print(f'Processing setting {setting}...')
+
+    df_sensitivities = get_sensitivities(**params, seed=SEED)
+    df_sensitivities[['elasticity_ratio_exact', 'derivative_ratio_exact']] = [
+        get_exact_sensitivity_ratio(params, parameter) for parameter in df_sensitivities.index
+    ]
+    sensitivities[setting] = df_sensitivities.sort_values('elasticity_ratio', key=np.abs, ascending=False)
+
+df_sensitivities = pd.concat(sensitivities, names=['setting', 'parameter'])
+
+with pd.option_context('display.width', 200, 'display.max_rows', None, 'display.max_columns', None):
+    print(df_sensitivities[[
+        'value', 'difference', 'elasticity_pfs', 'elasticity_os', 'elasticity_ratio', 'elasticity_ratio_exact',
+        'derivative_ratio', 'derivative_ratio_exact',
+    ]].round(3))
@@ -3,122 +3,21 @@ import pandas as pd
 from string import ascii_letters
 
 
-from simulation import simulate_trial, get_hazard_ratio_pfs, get_hazard_ratio_os, get_plot
+from settings import settings
+from simulation import get_trial_results, get_plot, write_trial
 
 path = os.path.dirname(__file__)
 
-N = 250 * 1000
-DURATION = 20
-
-BASE_P_PROGRESSION = 0.025
-BASE_P_DEATH = 0.025
-BASE_P_CENSOR = 0
-
-                                                                       
-settings = {
-    '1_progression_driven_low_translation': {
-        'n': N,
-        'duration': DURATION,
-        'p_progression_t': BASE_P_PROGRESSION / 2,
-        'p_progression_c': BASE_P_PROGRESSION,
-        'p_death_t': BASE_P_DEATH,
-        'p_death_c': BASE_P_DEATH,
-        'p_censor_t': BASE_P_CENSOR,
-        'p_censor_c': BASE_P_CENSOR,
-        'p_death_given_progression_t': BASE_P_DEATH * 1.5,
-        'p_death_given_progression_c': BASE_P_DEATH * 1.5,
-        'p_death_given_censor_t': BASE_P_DEATH,
-        'p_death_given_censor_c': BASE_P_DEATH
-    },
-   
-    '2_progression_driven_high_translation': {
-        'n': N,
-        'duration': DURATION,
-        'p_progression_t': BASE_P_PROGRESSION / 2,
-        'p_progression_c': BASE_P_PROGRESSION,
-        'p_death_t': BASE_P_DEATH,
-        'p_death_c': BASE_P_DEATH,
-        'p_censor_t': BASE_P_CENSOR,
-        'p_censor_c': BASE_P_CENSOR,
-        'p_death_given_progression_t': BASE_P_DEATH * 4,
-        'p_death_given_progression_c': BASE_P_DEATH * 4,
-        'p_death_given_censor_t': BASE_P_DEATH,
-        'p_death_given_censor_c': BASE_P_DEATH
-    },
-    '3_post_progression_death_driven': {
-        'n': N,
-        'duration': DURATION,
-        'p_progression_t': BASE_P_PROGRESSION,
-        'p_progression_c': BASE_P_PROGRESSION,
-        'p_death_t': BASE_P_DEATH,
-        'p_death_c': BASE_P_DEATH,
-        'p_censor_t': BASE_P_CENSOR,
-        'p_censor_c': BASE_P_CENSOR,
-        'p_death_given_progression_t': BASE_P_DEATH * 1.5,
-        'p_death_given_progression_c': BASE_P_DEATH * 4,
-        'p_death_given_censor_t': BASE_P_DEATH,
-        'p_death_given_censor_c': BASE_P_DEATH
-    },
-    '4_pre_progression_death_driven': {
-        'n': N,
-        'duration': DURATION,
-        'p_progression_t': BASE_P_PROGRESSION,
-        'p_progression_c': BASE_P_PROGRESSION,
-        'p_death_t': BASE_P_DEATH / 2,
-        'p_death_c': BASE_P_DEATH,
-        'p_censor_t': BASE_P_CENSOR,
-        'p_censor_c': BASE_P_CENSOR,
-        'p_death_given_progression_t': BASE_P_DEATH * 1.5,
-        'p_death_given_progression_c': BASE_P_DEATH * 1.5,
-        'p_death_given_censor_t': BASE_P_DEATH,
-        'p_death_given_censor_c': BASE_P_DEATH
-    },
-    '5_censoring_driven_treat_low': {
-        'n': N,
-        'duration': DURATION,
-        'p_progression_t': BASE_P_PROGRESSION * (3/4),
-        'p_progression_c': BASE_P_PROGRESSION,
-        'p_death_t': BASE_P_DEATH * (3/4),
-        'p_death_c': BASE_P_DEATH,
-        'p_censor_t': BASE_P_CENSOR + 0.05,
-        'p_censor_c': BASE_P_CENSOR + 0.025,
-        'p_death_given_progression_t': BASE_P_DEATH * 1.5,
-        'p_death_given_progression_c': BASE_P_DEATH * 1.5,
-        'p_death_given_censor_t': BASE_P_DEATH * 1.5,
-        'p_death_given_censor_c': BASE_P_DEATH
-    },
-    '6_censoring_driven_treat_high': {
-        'n': N,
-        'duration': DURATION,
-        'p_progression_t': BASE_P_PROGRESSION * (3/4),
-        'p_progression_c': BASE_P_PROGRESSION,
-        'p_death_t': BASE_P_DEATH * (3/4),
-        'p_death_c': BASE_P_DEATH,
-        'p_censor_t': BASE_P_CENSOR + 0.05,
-        'p_censor_c': BASE_P_CENSOR + 0.025,
-        'p_death_given_progression_t': BASE_P_DEATH * 1.5,
-        'p_death_given_progression_c': BASE_P_DEATH * 1.5,
-        'p_death_given_censor_t': BASE_P_DEATH * 3,
-        'p_death_given_censor_c': BASE_P_DEATH
-    },
-    '7_censoring_driven_control_high': {
-        'n': N,
-        'duration': DURATION,
-        'p_progression_t': BASE_P_PROGRESSION * (3/4),
-        'p_progression_c': BASE_P_PROGRESSION,
-        'p_death_t': BASE_P_DEATH * (3/4),
-        'p_death_c': BASE_P_DEATH,
-        'p_censor_t': BASE_P_CENSOR + 0.025,
-        'p_censor_c': BASE_P_CENSOR + 0.05,
-        'p_death_given_progression_t': BASE_P_DEATH * 1.5,
-        'p_death_given_progression_c': BASE_P_DEATH * 1.5,
-        'p_death_given_censor_t': BASE_P_DEATH,
-        'p_death_given_censor_c': BASE_P_DEATH * 3
-    }
-}
+ENGINE = 'numpy'
+
+# seeded trials are cached on disk, so rerunning the examples reuses them
+SEED = 42
 
 plots = []
 
+# the simulated participants behind each plot, for further analyses with read_trial
+os.makedirs(f'{path}/trials', exist_ok=True)
+
 def generate_table_row(index, params):
     letter = ascii_letters[index]
     row = f"{letter})"
@@ -134,10 +33,8 @@ for i, (setting, params) in enumerate(settings.items()):
     print(f'Processing setting {setting}...')
 
     table_out += generate_table_row(i, params)
-    df_trial = simulate_trial(**params)
-
-    hazard_ratio_pfs = get_hazard_ratio_pfs(df_trial)
-    hazard_ratio_os = get_hazard_ratio_os(df_trial)
+    df_trial, hazard_ratio_pfs, hazard_ratio_os = get_trial_results(**params, engine=ENGINE, seed=SEED)
+    write_trial(f'{path}/trials/trial_{setting}.arrow', df_trial, params, ENGINE, seed=SEED, hr_pfs=hazard_ratio_pfs, hr_os=hazard_ratio_os)
 
     plot = get_plot(df_trial, hazard_ratio_pfs, hazard_ratio_os)
 
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from settings import settings
+from simulation import simulate_transitions, STATES, DEAD
+
+path = os.path.dirname(__file__)
+
+# a trial too large to keep as a data frame, streamed period by period with a follow-up long enough to reach the median OS
+N = 5 * 1000 * 1000
+DURATION = 120
+SEED = 42
+
+params = {**settings['1_progression_driven_low_translation'], 'n': N, 'duration': DURATION}
+
+os.makedirs(f'{path}/streams', exist_ok=True)
+
+alive = np.array([N, N])
+writer = None
+
+for df_period in simulate_transitions(**params, seed=SEED):
+    table = pa.Table.from_pandas(df_period, preserve_index=False)
+    if writer is None:
+        writer = pq.ParquetWriter(f'{path}/streams/transitions.parquet', table.schema)
+    writer.write_table(table)
+
+    # overall survival by arm, updated as each period arrives
+    deaths = df_period[df_period['to_state'] == STATES.index(DEAD)]
+    alive -= np.bincount(deaths['group'], minlength=2)[::-1]
+    survival_treatment, survival_control = alive / N
+    t = df_period['time'].iloc[0]
+    print(f'Period {t}: OS treated {survival_treatment:.3f}, control {survival_control:.3f}')
+
+    # the remaining periods are not needed once the median OS of both arms has been reached
+    if max(survival_treatment, survival_control) < 0.5:
+        print(f'Median OS of both arms reached after {t} periods, stopping early')
+        break
+
+writer.close()
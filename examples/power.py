@@ -0,0 +1,160 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.special import ndtri
+
+from simulation import simulate_replicates
+
+ENDPOINTS = ['pfs', 'os']
+
+# power to reach and level of the two-sided Wald test of the Cox model
+POWER = 0.8
+ALPHA = 0.05
+
+# replicate trials are drawn in batches until the confidence interval of the power excludes the target; the interval is
+# checked after every batch, so its level is kept high
+CONFIDENCE = 0.99
+BATCH_SIZE = 250
+MAX_REPLICATES = 10 * 1000
+
+# range of participants per arm searched and the relative width of the final bracket
+MIN_N = 10
+MAX_N = 10 * 1000 * 1000
+TOLERANCE = 0.01
+
+
+def get_wilson_interval(successes, trials, confidence=CONFIDENCE):
+    """
+    Wilson score interval of a binomial proportion
+    """
+    z = ndtri(1 - (1 - confidence) / 2)
+    proportion = successes / trials
+    center = (proportion + z ** 2 / (2 * trials)) / (1 + z ** 2 / trials)
+    half_width = z / (1 + z ** 2 / trials) * np.sqrt(proportion * (1 - proportion) / trials + z ** 2 / (4 * trials ** 2))
+
+    return center - half_width, center + half_width
+
+
+def estimate_power(params, n, endpoint, target=POWER, alpha=ALPHA, confidence=CONFIDENCE, batch_size=BATCH_SIZE, max_replicates=MAX_REPLICATES, entropy=None, replicates=None):
+    """
+    Power of the Wald test at level alpha on endpoint ('pfs' or 'os') in trials with n participants per arm and the
+    transition probabilities in params, as the share of replicate trials of simulate_replicates rejecting. Batches are
+    drawn until the confidence interval of the power excludes target or max_replicates are reached. Each batch is seeded
+    from entropy, n and its index, so results do not depend on the order of evaluation, and kept in replicates ({n:
+    batches}), so that other endpoints and repeated evaluations at the same n reuse the trials; replicates must only be
+    shared between evaluations with the same entropy.
+    """
+    replicates = {} if replicates is None else replicates
+    batches = replicates.setdefault(n, [])
+
+    rejections = trials = 0
+    for batch in range(-(-max_replicates // batch_size)):
+        if batch == len(batches):
+            seed = np.random.SeedSequence(entropy, spawn_key=(n, batch))
+            # replicates of small trials can lack events, their infinite standard errors never reject
+            with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+                batches.append(simulate_replicates(batch_size, **{**params, 'n': n}, seed=seed))
+
+        rejections += int((batches[batch][f'p_{endpoint}'] < alpha).sum())
+        trials += len(batches[batch])
+
+        ci_lower, ci_upper = get_wilson_interval(rejections, trials, confidence=confidence)
+        if ci_lower > target or ci_upper < target:
+            break
+
+    return {'endpoint': endpoint, 'n': n, 'power': rejections / trials, 'ci_lower': ci_lower, 'ci_upper': ci_upper, 'replicates': trials}
+
+
+def find_sample_size(params, endpoint, target=POWER, n_min=MIN_N, n_max=MAX_N, tolerance=TOLERANCE, seed=None, replicates=None, **kwargs):
+    """
+    Smallest number of participants per arm at which the power on endpoint reaches target, see estimate_power for the
+    remaining arguments. The power grows with n, so n is doubled from n_min until the target is reached and the last
+    bracket is then bisected until it is narrower than tolerance relative to n. Where the confidence interval still
+    contains the target after the maximum number of replicates, the point estimate decides.
+    Returns the n found, or None if the power at n_max stays below target, and the estimates at all evaluated n.
+    """
+    entropy = np.random.SeedSequence(seed).entropy
+    evaluations = []
+
+    def reaches_target(n):
+        estimate = estimate_power(params, n, endpoint, target=target, entropy=entropy, replicates=replicates, **kwargs)
+        evaluations.append(estimate)
+        return estimate['power'] >= target
+
+    low, high = None, n_min
+    while not reaches_target(high):
+        if high >= n_max:
+            return None, pd.DataFrame(evaluations)
+        low, high = high, min(2 * high, n_max)
+
+    while low is not None and high - low > max(1, tolerance * high):
+        middle = (low + high) // 2
+        if reaches_target(middle):
+            high = middle
+        else:
+            low = middle
+
+    return high, pd.DataFrame(evaluations)
+
+
+def find_sample_sizes(params, endpoints=ENDPOINTS, target=POWER, seed=None, **kwargs):
+    """
+    Required participants per arm for every endpoint, see find_sample_size. The endpoints are searched on the same
+    replicate trials. Returns one row per endpoint with the n found and the power estimate at it, and the estimates at
+    all evaluated n.
+    """
+    # the shared replicates are only the same trials for every endpoint if all searches draw them from one entropy,
+    # which a seed of None would otherwise renew per endpoint
+    seed = np.random.SeedSequence(seed).entropy
+    replicates = {}
+
+    rows = []
+    evaluations = []
+    for endpoint in endpoints:
+        n, df_evaluations = find_sample_size(params, endpoint, target=target, seed=seed, replicates=replicates, **kwargs)
+        evaluations.append(df_evaluations)
+
+        row = {'endpoint': endpoint, 'n': n}
+        if n is not None:
+            row.update(df_evaluations[df_evaluations['n'] == n].iloc[-1].drop(['endpoint', 'n']).to_dict())
+        rows.append(row)
+
+    return pd.DataFrame(rows).astype({'n': 'Int64'}).set_index('endpoint'), pd.concat(evaluations, ignore_index=True)
+
+
+if __name__ == '__main__':
+    from settings import settings
+
+    parser = argparse.ArgumentParser(description='Participants per arm needed to reach a power on PFS and OS, by simulation.')
+    parser.add_argument('--setting', default=next(iter(settings)), choices=list(settings), help='transition probabilities and duration of one of the article settings')
+    parser.add_argument('--set', nargs='+', default=[], metavar='NAME=VALUE', help='overrides of single parameters of the setting, e.g. p_progression_t=0.02 duration=30')
+    parser.add_argument('--power', type=float, default=POWER)
+    parser.add_argument('--alpha', type=float, default=ALPHA)
+    parser.add_argument('--confidence', type=float, default=CONFIDENCE, help='level of the interval deciding whether the power is above or below the target')
+    parser.add_argument('--max-replicates', type=int, default=MAX_REPLICATES, help='replicate trials at most per evaluated n')
+    parser.add_argument('--max-n', type=int, default=MAX_N)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--verbose', action='store_true', help='print the estimates at all evaluated n')
+    args = parser.parse_args()
+
+    params = dict(settings[args.setting])
+    for assignment in args.set:
+        name, value = assignment.split('=')
+        if name not in params:
+            parser.error(f'Unknown parameter {name!r}, expected one of {list(params)}')
+        params[name] = int(value) if name == 'duration' else float(value)
+
+    df_sample_sizes, df_evaluations = find_sample_sizes(
+        params, target=args.power, alpha=args.alpha, confidence=args.confidence, max_replicates=args.max_replicates,
+        n_max=args.max_n, tolerance=args.tolerance, seed=args.seed,
+    )
+
+    with pd.option_context('display.width', 200, 'display.max_rows', None, 'display.max_columns', None):
+        if args.verbose:
+            print(f'{df_evaluations.round(3)}\n')
+        print(f'Participants per arm for {args.power:.0%} power at alpha {args.alpha:g}:\n{df_sample_sizes.round(3)}')
+
+    for endpoint in df_sample_sizes.index[df_sample_sizes['n'].isna()]:
+        print(f'The power on {endpoint} stays below {args.power:.0%} up to {args.max_n:,} participants per arm')
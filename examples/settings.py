@@ -0,0 +1,110 @@
+# Settings of the examples in the article
+
+N = 250 * 1000
+DURATION = 20
+
+BASE_P_PROGRESSION = 0.025
+BASE_P_DEATH = 0.025
+BASE_P_CENSOR = 0
+
+settings = {
+    '1_progression_driven_low_translation': {
+        'n': N,
+        'duration': DURATION,
+        'p_progression_t': BASE_P_PROGRESSION / 2,
+        'p_progression_c': BASE_P_PROGRESSION,
+        'p_death_t': BASE_P_DEATH,
+        'p_death_c': BASE_P_DEATH,
+        'p_censor_t': BASE_P_CENSOR,
+        'p_censor_c': BASE_P_CENSOR,
+        'p_death_given_progression_t': BASE_P_DEATH * 1.5,
+        'p_death_given_progression_c': BASE_P_DEATH * 1.5,
+        'p_death_given_censor_t': BASE_P_DEATH,
+        'p_death_given_censor_c': BASE_P_DEATH
+    },
+   
+    '2_progression_driven_high_translation': {
+        'n': N,
+        'duration': DURATION,
+        'p_progression_t': BASE_P_PROGRESSION / 2,
+        'p_progression_c': BASE_P_PROGRESSION,
+        'p_death_t': BASE_P_DEATH,
+        'p_death_c': BASE_P_DEATH,
+        'p_censor_t': BASE_P_CENSOR,
+        'p_censor_c': BASE_P_CENSOR,
+        'p_death_given_progression_t': BASE_P_DEATH * 4,
+        'p_death_given_progression_c': BASE_P_DEATH * 4,
+        'p_death_given_censor_t': BASE_P_DEATH,
+        'p_death_given_censor_c': BASE_P_DEATH
+    },
+    '3_post_progression_death_driven': {
+        'n': N,
+        'duration': DURATION,
+        'p_progression_t': BASE_P_PROGRESSION,
+        'p_progression_c': BASE_P_PROGRESSION,
+        'p_death_t': BASE_P_DEATH,
+        'p_death_c': BASE_P_DEATH,
+        'p_censor_t': BASE_P_CENSOR,
+        'p_censor_c': BASE_P_CENSOR,
+        'p_death_given_progression_t': BASE_P_DEATH * 1.5,
+        'p_death_given_progression_c': BASE_P_DEATH * 4,
+        'p_death_given_censor_t': BASE_P_DEATH,
+        'p_death_given_censor_c': BASE_P_DEATH
+    },
+    '4_pre_progression_death_driven': {
+        'n': N,
+        'duration': DURATION,
+        'p_progression_t': BASE_P_PROGRESSION,
+        'p_progression_c': BASE_P_PROGRESSION,
+        'p_death_t': BASE_P_DEATH / 2,
+        'p_death_c': BASE_P_DEATH,
+        'p_censor_t': BASE_P_CENSOR,
+        'p_censor_c': BASE_P_CENSOR,
+        'p_death_given_progression_t': BASE_P_DEATH * 1.5,
+        'p_death_given_progression_c': BASE_P_DEATH * 1.5,
+        'p_death_given_censor_t': BASE_P_DEATH,
+        'p_death_given_censor_c': BASE_P_DEATH
+    },
+    '5_censoring_driven_treat_low': {
+        'n': N,
+        'duration': DURATION,
+        'p_progression_t': BASE_P_PROGRESSION * (3/4),
+        'p_progression_c': BASE_P_PROGRESSION,
+        'p_death_t': BASE_P_DEATH * (3/4),
+        'p_death_c': BASE_P_DEATH,
+        'p_censor_t': BASE_P_CENSOR + 0.05,
+        'p_censor_c': BASE_P_CENSOR + 0.025,
+        'p_death_given_progression_t': BASE_P_DEATH * 1.5,
+        'p_death_given_progression_c': BASE_P_DEATH * 1.5,
+        'p_death_given_censor_t': BASE_P_DEATH * 1.5,
+        'p_death_given_censor_c': BASE_P_DEATH
+    },
+    '6_censoring_driven_treat_high': {
+        'n': N,
+        'duration': DURATION,
+        'p_progression_t': BASE_P_PROGRESSION * (3/4),
+        'p_progression_c': BASE_P_PROGRESSION,
+        'p_death_t': BASE_P_DEATH * (3/4),
+        'p_death_c': BASE_P_DEATH,
+        'p_censor_t': BASE_P_CENSOR + 0.05,
+        'p_censor_c': BASE_P_CENSOR + 0.025,
+        'p_death_given_progression_t': BASE_P_DEATH * 1.5,
+        'p_death_given_progression_c': BASE_P_DEATH * 1.5,
+        'p_death_given_censor_t': BASE_P_DEATH * 3,
+        'p_death_given_censor_c': BASE_P_DEATH
+    },
+    '7_censoring_driven_control_high': {
+        'n': N,
+        'duration': DURATION,
+        'p_progression_t': BASE_P_PROGRESSION * (3/4),
+        'p_progression_c': BASE_P_PROGRESSION,
+        'p_death_t': BASE_P_DEATH * (3/4),
+        'p_death_c': BASE_P_DEATH,
+        'p_censor_t': BASE_P_CENSOR + 0.025,
+        'p_censor_c': BASE_P_CENSOR + 0.05,
+        'p_death_given_progression_t': BASE_P_DEATH * 1.5,
+        'p_death_given_progression_c': BASE_P_DEATH * 1.5,
+        'p_death_given_censor_t': BASE_P_DEATH,
+        'p_death_given_censor_c': BASE_P_DEATH * 3
+    }
+}
@@ -1,13 +1,217 @@
+import hashlib
+import inspect
+import io
+import json
+import logging
+import os
 import random
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import reduce, wraps
+from itertools import repeat
+
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
 import pandas as pd
-from lifelines import CoxPHFitter, KaplanMeierFitter
+from scipy.special import digamma, ndtr, ndtri, polygamma
 
 NO_PROGRESSION = 'no progression'
 PROGRESSED = 'progressed'
 CENSORED = 'censored'
 DEAD = 'dead'
 
+# integer codes of the states used by the vectorized engine are the positions in this list
+STATES = [NO_PROGRESSION, PROGRESSED, CENSORED, DEAD]
+
+ENGINES = ['study', 'numpy', 'direct', 'cohort']
+
+# engines that simulate every participant
+PARTICIPANT_ENGINES = ['study', 'numpy', 'direct']
+
+# engines that step through the periods and can stream the transitions of each period
+STREAMING_ENGINES = ['study', 'numpy']
+
+# bump the version of an engine whenever its output for a given seed changes, so that cached trials are not reused
+ENGINE_VERSIONS = {'study': 2, 'numpy': 3, 'direct': 2, 'cohort': 1}
+
+# on-disk cache of simulated trials, shared by the application and the examples
+CACHE_DIR = os.environ.get('TRIAL_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'oncology-trial-simulator'))
+CACHE_SIZE_LIMIT = int(os.environ.get('TRIAL_CACHE_SIZE_LIMIT', 1024 ** 3))
+
+# ways the 'direct' engine can couple the random numbers of the arms and of scenarios simulated with the same seed
+COUPLINGS = ['common', 'antithetic']
+
+# engines that can simulate shards of a trial in parallel
+PARALLEL_ENGINES = ['numpy', 'direct']
+
+# participants per arm simulated at once when a trial is split into shards, bounds the memory use per shard
+CHUNK_SIZE = 1000 * 1000
+
+# tie handling of the Cox fit
+TIES = ['efron', 'breslow']
+
+# implementations of the Cox fit in get_hr
+BACKENDS = ['native', 'lifelines']
+
+# size in inches and resolution of the plots encoded by get_plot_png, and the number of encoded plots kept in memory
+PLOT_SIZE = (4, 3)
+PLOT_DPI = 150
+PLOT_CACHE_SIZE = 256
+PLOT_CACHE = OrderedDict()
+
+# number of states that can be left above which a MultiStateStudy groups the participants by state with a single sort
+# rather than scanning all participants once per state
+SORTED_GROUPING_STATES = 8
+
+# quantiles reported for the hazard ratios of replicate trials
+QUANTILES = [0.025, 0.25, 0.5, 0.75, 0.975]
+
+# transition probabilities of an arm in the argument order of get_transition_matrix, the relative change of one of
+# them by which get_sensitivities perturbs a trial in either direction, and the absolute increase of a probability of zero
+ARM_PARAMS = ['p_progression', 'p_death', 'p_censor', 'p_death_given_progression', 'p_death_given_censor']
+SENSITIVITY_STEP = 0.1
+SENSITIVITY_ABSOLUTE_STEP = 0.0025
+
+# opt-in instrumentation of the simulation, analysis and plotting stages: '' is off, 'time' records the wall time of
+# every stage and 'memory' also its peak traced allocation, which slows allocations down considerably
+INSTRUMENTATION_LEVELS = ['', 'time', 'memory']
+INSTRUMENTATION = os.environ.get('TRIAL_INSTRUMENTATION', '')
+
+# the most recent stage records of all threads; every record is also logged as a JSON line at level INFO
+STAGE_LOG_SIZE = 1000
+STAGE_LOG = deque(maxlen=STAGE_LOG_SIZE)
+logger = logging.getLogger('trial_simulator')
+
+
+class StageContext(threading.local):
+    """
+    Stages running in the current thread and the lists collecting their records, see measure_stage and record_stages
+    """
+    def __init__(self):
+        self.running = []
+        self.collectors = []
+
+
+stage_context = StageContext()
+
+
+@contextmanager
+def measure_stage(stage, **fields):
+    """
+    Records the code run in the context as a stage with the given fields (e.g. n): its wall time in seconds and, with
+    INSTRUMENTATION 'memory', the peak traced allocation in bytes above the allocation at its start. The record is
+    yielded, so that fields known only later can be added, and on exit it is logged, appended to STAGE_LOG and to the
+    lists of record_stages in the same thread. Nested stages are recorded separately and count towards the peak of the
+    enclosing one. tracemalloc traces all threads, so the peaks of stages running concurrently overlap.
+    Does nothing while INSTRUMENTATION is off.
+    """
+    if not INSTRUMENTATION:
+        yield {}
+        return
+
+    if INSTRUMENTATION not in INSTRUMENTATION_LEVELS:
+        raise ValueError(f'Unknown instrumentation {INSTRUMENTATION!r}, expected one of {INSTRUMENTATION_LEVELS}')
+
+    running = stage_context.running
+    record = {'stage': stage, **fields, 'timestamp': time.time()}
+
+    frame = None
+    if INSTRUMENTATION == 'memory':
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        current, peak = tracemalloc.get_traced_memory()
+        # the peak is reset for this stage, so the enclosing stage keeps the peak it reached so far
+        if running and running[-1] is not None:
+            running[-1]['peak'] = max(running[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        frame = {'start': current, 'peak': current}
+
+    running.append(frame)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as error:
+        record['error'] = type(error).__name__
+        raise
+    finally:
+        record['time'] = time.perf_counter() - start
+        running.pop()
+
+        if frame is not None:
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            record['peak_memory'] = peak - frame['start']
+            if running and running[-1] is not None:
+                running[-1]['peak'] = max(running[-1]['peak'], peak)
+
+        STAGE_LOG.append(record)
+        for records in stage_context.collectors:
+            records.append(record)
+        logger.info(json.dumps(record))
+
+
+@contextmanager
+def record_stages():
+    """
+    Collects the records of all stages measured in the current thread within the context in the yielded list
+    """
+    records = []
+    stage_context.collectors.append(records)
+    try:
+        yield records
+    finally:
+        stage_context.collectors.pop()
+
+
+def instrument(stage, arguments=(), get_fields=None):
+    """
+    Decorator measuring every call of the decorated function as a stage, see measure_stage. The values of the named
+    arguments are recorded as fields, as well as the fields returned by get_fields for all bound arguments.
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENTATION:
+                return function(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            fields = {name: bound.arguments[name] for name in arguments}
+            if get_fields is not None:
+                fields.update(get_fields(bound.arguments))
+
+            with measure_stage(stage, **fields):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_participant_count(data, weights_col=None):
+    """
+    Number of participants in a simulated trial in any format, or in weighted rows with weights_col
+    """
+    if is_life_table(data):
+        return int(data.loc[data['time'] == data['time'].min(), 'at_risk_os'].sum())
+
+    if weights_col is not None:
+        return int(data[weights_col].sum())
+
+    return len(data)
+
+
+def get_data_fields(arguments):
+    return {'n': get_participant_count(arguments['data'], arguments.get('weights_col'))}
+
 
 class StudyParticipant:
     """
@@ -99,20 +303,535 @@ class Study:
                 state = random.choices([DEAD, PROGRESSED, CENSORED, NO_PROGRESSION], weights = [p_d, p_p, p_c, 1-p_d-p_p-p_c], k=1)[0]
 
             if state != participant.state:
+                previous_state = participant.state
                 participant.update_state(state, t)
-            
-        for participant in self.treatment_group:
-            draw_events(self.t, participant, self.p_progression_t, self.p_death_t, self.p_censor_t, self.p_death_given_progression_t, self.p_death_given_censor_t)
-        
-        for participant in self.control_group:
-            draw_events(self.t, participant, self.p_progression_c, self.p_death_c, self.p_censor_c, self.p_death_given_progression_c, self.p_death_given_censor_c)
+                return previous_state
+
+        changed_t = [
+            (id, previous_state) for id, participant in enumerate(self.treatment_group)
+            if (previous_state := draw_events(self.t, participant, self.p_progression_t, self.p_death_t, self.p_censor_t, self.p_death_given_progression_t, self.p_death_given_censor_t))
+        ]
+
+        changed_c = [
+            (id, previous_state) for id, participant in enumerate(self.control_group)
+            if (previous_state := draw_events(self.t, participant, self.p_progression_c, self.p_death_c, self.p_censor_c, self.p_death_given_progression_c, self.p_death_given_censor_c))
+        ]
+
+        transitions = []
+        for group, participants, changed in [(1, self.treatment_group, changed_t), (0, self.control_group, changed_c)]:
+            ids = np.array([id for id, _ in changed], dtype=np.int64)
+            from_states = np.array([STATES.index(previous_state) for _, previous_state in changed], dtype=np.int8)
+            to_states = np.array([STATES.index(participants[id].state) for id, _ in changed], dtype=np.int8)
+            transitions.append((group, ids, from_states, to_states))
 
         self.complete = self.check_complete()
 
+        return transitions
 
+    def iter_transitions(self):
+        """
+        Simulates the remaining periods and yields the transitions of each period as a data frame, see get_transition_data
+        """
+        while not self.complete:
+            transitions = self.simulate_period()
+            yield get_transition_data(self.t, transitions)
+
+
+def get_transition_matrix(p_progression, p_death, p_censor, p_death_given_progression, p_death_given_censor):
+    """
+    Per-period transition probabilities between STATES, rows are the current and columns the next state
+    """
+    return np.array([
+        [1 - p_progression - p_death - p_censor, p_progression, p_censor, p_death],
+        [0, 1 - p_death_given_progression, 0, p_death_given_progression],
+        [0, 0, 1 - p_death_given_censor, p_death_given_censor],
+        [0, 0, 0, 1],
+    ])
+
+
+class MultiStateModel:
+    """
+    Class representing a two-arm trial as a multi-state model: a list of states, in which every participant starts in
+    the first, the per-period transition probabilities between them in each arm (rows are the current and columns the
+    next state) and, per endpoint, the states whose first entry is an event and those whose first entry ends the
+    follow-up of the endpoint without an event
+    """
+    def __init__(self, states, transitions_treatment, transitions_control, events, censoring=None):
+        self.states = list(states)
+        if len(set(self.states)) != len(self.states):
+            raise ValueError(f'States must be unique, got {self.states}')
+
+        self.transitions = {1: np.asarray(transitions_treatment, dtype=float), 0: np.asarray(transitions_control, dtype=float)}
+        for group, transitions in self.transitions.items():
+            if transitions.shape != (len(self.states), len(self.states)):
+                raise ValueError(f'Transition matrix of group {group} has shape {transitions.shape}, expected one row and column per state')
+            if (transitions < 0).any() or not np.allclose(transitions.sum(axis=1), 1):
+                raise ValueError(f'Rows of the transition matrix of group {group} must be probabilities summing to one')
+
+        def get_state_indices(states):
+            unknown = [state for state in states if state not in self.states]
+            if unknown:
+                raise ValueError(f'Unknown states {unknown}, expected states of {self.states}')
+            return [self.states.index(state) for state in states]
+
+        self.events = {endpoint: get_state_indices(states) for endpoint, states in events.items()}
+        self.censoring = {endpoint: get_state_indices(states) for endpoint, states in (censoring or {}).items()}
+        if not set(self.censoring) <= set(self.events):
+            raise ValueError(f'Censoring of endpoints without events {sorted(set(self.censoring) - set(self.events))}')
+
+        # only the entry times of these states are recorded per participant
+        self.recorded_states = sorted({state for states in [*self.events.values(), *self.censoring.values()] for state in states})
+        self.state_type = np.min_scalar_type(-len(self.states))
+
+        # a participant stays in its state if its draw falls into the interval of the diagonal of the cumulative row, so
+        # that only those leaving look up their next state; states that cannot be left are never drawn for
+        self.cumulative_transitions = {}
+        self.stay_intervals = {}
+        self.transient_states = {}
+        for group, transitions in self.transitions.items():
+            cumulative_transitions = np.cumsum(transitions, axis=1)
+            # guard against rows summing to slightly less than one due to floating point error
+            cumulative_transitions[:, -1] = 1
+
+            diagonal = np.arange(len(self.states))
+            self.cumulative_transitions[group] = cumulative_transitions
+            self.stay_intervals[group] = np.stack([cumulative_transitions[diagonal, diagonal] - transitions[diagonal, diagonal], cumulative_transitions[diagonal, diagonal]], axis=1)
+            self.transient_states[group] = np.flatnonzero(transitions[diagonal, diagonal] < 1)
+
+    @classmethod
+    def from_probabilities(cls, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c):
+        """
+        Four-state model of the article over STATES, with the endpoints of TrialData.get_endpoint
+        """
+        params_treatment, params_control = get_arm_params(p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c)
+
+        return cls(
+            STATES, get_transition_matrix(*params_treatment), get_transition_matrix(*params_control),
+            events={'pfs': [PROGRESSED, DEAD], 'os': [DEAD]}, censoring={'pfs': [CENSORED]},
+        )
+
+    def get_endpoint(self, entry_time, endpoint, duration):
+        """
+        Time of the event or of the end of follow-up and whether an event occurred for every participant, from the first
+        entry times of the recorded states ({state: times}, 0 if never entered) as kept by ModelArm
+        """
+        def get_first_entry(states):
+            return reduce(lambda first, times: np.where((first == 0) | ((times > 0) & (times < first)), times, first), [entry_time[state] for state in states], 0)
+
+        event_time = get_first_entry(self.events[endpoint])
+        censor_time = get_first_entry(self.censoring.get(endpoint, []))
+
+        censored = (censor_time > 0) & ((event_time == 0) | (censor_time < event_time))
+        end_time = np.where(censored, censor_time, event_time)
+
+        return np.where(end_time > 0, end_time, duration), (event_time > 0) & ~censored
+
+
+class ModelArm:
+    """
+    Class representing one arm of a trial simulated from a MultiStateModel as integer-coded NumPy arrays: the state of
+    every participant and the period of its first entry into each recorded state (0 means never)
+    """
+    def __init__(self, n, recorded_states, state_type=np.int8):
+        self.state = np.zeros(n, dtype=state_type)
+        self.entry_time = {state: np.zeros(n, dtype=np.int32) for state in recorded_states}
+
+    def draw_events(self, t, model, group, rng, occupancy=None):
+        """
+        Draws the transitions of period t in the arm of group and returns the participants that changed state with their
+        previous and new state. With occupancy, the number of participants per state, empty states are skipped and the
+        counts are updated in place.
+        """
+        transient_states = model.transient_states[group]
+        if occupancy is not None:
+            transient_states = transient_states[occupancy[transient_states] > 0]
+
+        if len(transient_states) > SORTED_GROUPING_STATES:
+            # a stable counting sort groups the participants by state in one pass instead of one scan per state
+            order = np.argsort(self.state, kind='stable')
+            starts = np.concatenate([[0], np.cumsum(np.bincount(self.state, minlength=len(model.states)))])
+            participants = {state: order[starts[state]:starts[state + 1]] for state in transient_states}
+        else:
+            participants = {state: np.flatnonzero(self.state == state) for state in transient_states}
+
+        # one uniform draw for the participants in each state that can be left; only a draw outside the interval of
+        # staying is looked up in the cumulative row
+        changed = [np.zeros(0, dtype=np.int64)]
+        states, next_states = [np.zeros(0, dtype=self.state.dtype)], [np.zeros(0, dtype=self.state.dtype)]
+        for state, in_state in participants.items():
+            u = rng.random(in_state.size)
+
+            stay_lower, stay_upper = model.stay_intervals[group][state]
+            leaving = (u < stay_lower) | (u >= stay_upper)
+            changed.append(in_state[leaving])
+            states.append(np.full(leaving.sum(), state, dtype=self.state.dtype))
+            next_states.append(np.searchsorted(model.cumulative_transitions[group][state], u[leaving], side='right').astype(self.state.dtype))
+
+        changed, state, next_state = np.concatenate(changed), np.concatenate(states), np.concatenate(next_states)
+        self.state[changed] = next_state
+        if occupancy is not None:
+            occupancy += np.bincount(next_state, minlength=occupancy.size) - np.bincount(state, minlength=occupancy.size)
+
+        for recorded_state, entry_time in self.entry_time.items():
+            entering = changed[next_state == recorded_state]
+            entry_time[entering[entry_time[entering] == 0]] = t
+
+        return changed, state, next_state
+
+
+class StudyArm(ModelArm):
+    """
+    Arm of the four-state model of the article, with the entry times of its events as named attributes
+    """
+    def __init__(self, n):
+        super().__init__(n, [STATES.index(state) for state in (PROGRESSED, CENSORED, DEAD)])
+        self.progress_time = self.entry_time[STATES.index(PROGRESSED)]
+        self.censor_time = self.entry_time[STATES.index(CENSORED)]
+        self.death_time = self.entry_time[STATES.index(DEAD)]
+
+
+class MultiStateStudy:
+    """
+    Class representing a clinical trial simulated from a MultiStateModel, drawing the transitions of a whole arm in one
+    batched call per period
+    """
+
+    def __init__(self, model, n, duration, rng=None):
+        self.t = 0
+        self.model = model
+        self.duration = duration
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+        self.treatment_group = self.create_arm(n)
+        self.control_group = self.create_arm(n)
+        # number of participants per state in each arm, every participant starts in the first state
+        self.occupancy = {group: np.zeros(len(model.states), dtype=np.int64) for group in (1, 0)}
+        for occupancy in self.occupancy.values():
+            occupancy[0] = n
+        self.complete = False
+
+    def create_arm(self, n):
+        return ModelArm(n, self.model.recorded_states, state_type=self.model.state_type)
+
+    def get_treatment_group(self):
+        return self.treatment_group
+
+    def get_control_group(self):
+        return self.control_group
+
+    def check_complete(self):
+        if self.t >= self.duration:
+            return True
+
+        return not any(self.occupancy[group][self.model.transient_states[group]].any() for group in (1, 0))
+
+    def simulate_period(self):
+        self.t += 1
 
-def simulate_trial(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c):
-    study = Study(
+        transitions = [
+            (1, *self.treatment_group.draw_events(self.t, self.model, 1, self.rng, occupancy=self.occupancy[1])),
+            (0, *self.control_group.draw_events(self.t, self.model, 0, self.rng, occupancy=self.occupancy[0])),
+        ]
+
+        self.complete = self.check_complete()
+
+        return transitions
+
+    def iter_transitions(self):
+        """
+        Simulates the remaining periods and yields the transitions of each period as a data frame, see get_transition_data
+        """
+        while not self.complete:
+            transitions = self.simulate_period()
+            yield get_transition_data(self.t, transitions)
+
+
+class VectorizedStudy(MultiStateStudy):
+    """
+    Class representing a clinical trial of the four-state model of the article, simulated as a MultiStateStudy
+    """
+
+    def __init__(
+            self, n, duration,
+            p_progression_treatment, p_death_treatment, p_censor_treatment,  p_death_given_progression_treatment, p_death_given_censor_treatment,
+            p_progression_control, p_death_control, p_censor_control, p_death_given_progression_control, p_death_given_censor_control,
+            rng=None
+            ):
+        model = MultiStateModel.from_probabilities(
+            p_progression_treatment, p_death_treatment, p_censor_treatment, p_death_given_progression_treatment, p_death_given_censor_treatment,
+            p_progression_control, p_death_control, p_censor_control, p_death_given_progression_control, p_death_given_censor_control,
+        )
+        super().__init__(model, n, duration, rng=rng)
+
+    def create_arm(self, n):
+        return StudyArm(n)
+
+
+def get_transition_data(t, transitions):
+    """
+    Transitions in period t as one row per participant that changed state, with the participant's position in its arm,
+    its group, the period and the previous and new state as positions in STATES, or in the states of the model of a
+    MultiStateStudy. transitions holds a (group, participants, from_states, to_states) tuple per arm.
+    """
+    return pd.DataFrame({
+        'participant': np.concatenate([participants for _, participants, _, _ in transitions]),
+        'group': np.concatenate([np.full(participants.size, group, dtype=np.int8) for group, participants, _, _ in transitions]),
+        'time': t,
+        'from_state': np.concatenate([from_states for _, _, from_states, _ in transitions]),
+        'to_state': np.concatenate([to_states for _, _, _, to_states in transitions]),
+    })
+
+
+def draw_waiting_times(p, size, rng, uniforms=None):
+    """
+    Number of periods until a state with constant per-period exit probability p is left (never if p is zero). With
+    uniforms, they are transformed by the inverse distribution function instead of drawing from rng.
+    """
+    if p <= 0:
+        return np.full(size, np.iinfo(np.int64).max)
+
+    if uniforms is None:
+        return rng.geometric(p, size=size)
+
+    if p >= 1:
+        return np.ones(size, dtype=np.int64)
+
+    # P(T > k) = (1 - p) ** k, capped so that the times of tiny p still fit the integer type
+    waiting_times = np.ceil(np.log1p(-uniforms) / np.log1p(-p))
+    return np.clip(waiting_times, 1, 2.0 ** 62).astype(np.int64)
+
+
+def draw_uniforms(n, rng, antithetic=False):
+    """
+    Uniforms of n participant slots as taken by sample_arm, one row each for the time to leave 'no progression', the
+    next state and the time to death. With antithetic, the second half of the slots mirrors the first (1 - u).
+    """
+    if not antithetic:
+        return rng.random((3, n))
+
+    half = rng.random((3, (n + 1) // 2))
+    return np.concatenate([half, 1 - half], axis=1)[:, :n]
+
+
+def sample_arm(n, duration, p_progression, p_death, p_censor, p_death_given_progression, p_death_given_censor, rng, uniforms=None):
+    """
+    Draws the complete path of every participant in an arm without stepping through the periods: a geometric time to
+    leave 'no progression', a categorical draw of the next state and a geometric time from 'progressed' or 'censored' to death.
+    Events after the end of the trial are truncated. With uniforms from draw_uniforms, every participant's path is a
+    monotone function of the uniforms of its slot, so arms and scenarios sampled from the same uniforms are coupled.
+    """
+    arm = StudyArm(n)
+    u_exit, u_next, u_death = uniforms if uniforms is not None else (None, None, None)
+
+    p_exit = p_progression + p_death + p_censor
+    exit_time = draw_waiting_times(p_exit, n, rng, uniforms=u_exit)
+    exited = np.flatnonzero(exit_time <= duration)
+    exit_time = exit_time[exited]
+
+    u = (rng.random(exited.size) if uniforms is None else u_next[exited]) * p_exit
+    next_state = np.where(u < p_progression, STATES.index(PROGRESSED), np.where(u < p_progression + p_censor, STATES.index(CENSORED), STATES.index(DEAD)))
+    arm.state[exited] = next_state
+
+    for state, p_death_given_state, state_time in [
+        (PROGRESSED, p_death_given_progression, arm.progress_time),
+        (CENSORED, p_death_given_censor, arm.censor_time),
+    ]:
+        in_state = next_state == STATES.index(state)
+        participants, entry_time = exited[in_state], exit_time[in_state]
+        state_time[participants] = entry_time
+
+        # compared before adding, the waiting time of a zero death probability would overflow
+        waiting_time = draw_waiting_times(p_death_given_state, participants.size, rng, uniforms=None if uniforms is None else u_death[participants])
+        died = waiting_time <= duration - entry_time
+        arm.state[participants[died]] = STATES.index(DEAD)
+        arm.death_time[participants[died]] = entry_time[died] + waiting_time[died]
+
+    died_without_progression = next_state == STATES.index(DEAD)
+    arm.death_time[exited[died_without_progression]] = exit_time[died_without_progression]
+
+    return arm
+
+
+class ParticipantData:
+    """
+    Base of the classes representing the participants of a simulated trial in compact columns, with a boolean arm
+    indicator treated (treatment arm first) and the duration. Subclasses provide the event time and indicator of each
+    endpoint with get_endpoint, from which the participant ids and weighted events are derived on request.
+    """
+    def __len__(self):
+        return self.treated.size
+
+    def get_participant_ids(self):
+        n_treatment = int(self.treated.sum())
+        return [f't_{id}' for id in range(n_treatment)] + [f'c_{id}' for id in range(len(self) - n_treatment)]
+
+    def get_weighted_events(self, endpoint):
+        """
+        Rows of (time, event, group, weight) with the number of participants per distinct combination, like
+        get_weighted_events of a life table
+        """
+        event_time, has_event = self.get_endpoint(endpoint)
+
+        # event times are small integers, so the combinations can be counted with a single bincount
+        counts = np.bincount((self.treated * 2 + has_event) * (self.duration + 1) + event_time, minlength=4 * (self.duration + 1))
+        combinations = np.flatnonzero(counts)
+        group_event, time = np.divmod(combinations, self.duration + 1)
+
+        return pd.DataFrame({'time': time, 'event': group_event % 2, 'group': group_event // 2, 'weight': counts[combinations]})
+
+
+class ModelTrialData(ParticipantData):
+    """
+    Class representing the participants of a trial simulated from a MultiStateModel in compact columns: a boolean arm
+    indicator with the treatment arm first, the final state as in ModelArm and the first entry time into each recorded
+    state in the smallest unsigned integer type holding the duration (time 0 means never). Participant ids and the data
+    frame are only built on request.
+    """
+    def __init__(self, model, treated, state, entry_time, duration):
+        time_type = np.min_scalar_type(duration)
+
+        self.model = model
+        self.duration = duration
+        self.treated = np.asarray(treated, dtype=bool)
+        self.state = np.asarray(state).astype(model.state_type, copy=False)
+        self.entry_time = {state: np.asarray(times).astype(time_type, copy=False) for state, times in entry_time.items()}
+
+    @classmethod
+    def from_arms(cls, model, treatment_group, control_group, duration):
+        return cls(
+            model,
+            np.repeat([True, False], [treatment_group.state.size, control_group.state.size]),
+            np.concatenate([treatment_group.state, control_group.state]),
+            {
+                state: np.concatenate([treatment_group.entry_time[state], control_group.entry_time[state]], dtype=np.min_scalar_type(duration), casting='unsafe')
+                for state in model.recorded_states
+            },
+            duration,
+        )
+
+    def get_endpoint(self, endpoint):
+        """
+        Time of the event or of the end of follow-up and whether an event occurred for every participant, for an
+        endpoint of the model
+        """
+        return self.model.get_endpoint(self.entry_time, endpoint, self.duration)
+
+    @instrument('frame', get_fields=lambda arguments: {'n': len(arguments['self'])})
+    def to_frame(self):
+        """
+        One row per participant with its group, final state and first entry time into each recorded state (NaN if never
+        entered), and the event time and indicator of every endpoint of the model in the columns of simulate_trial, e.g.
+        'pfs_event_time' and 'has_pfs_event'
+        """
+        df = pd.DataFrame({
+            'participant': self.get_participant_ids(),
+            'group': self.treated.astype(int),
+            'state': pd.Categorical.from_codes(self.state, self.model.states),
+            **{f't_{self.model.states[state]}': np.where(times > 0, times, np.nan) for state, times in self.entry_time.items()},
+            'duration': self.duration,
+        })
+
+        for endpoint in self.model.events:
+            event_time, has_event = self.get_endpoint(endpoint)
+            df[f'{endpoint}_event_time'] = event_time.astype(float)
+            df[f'has_{endpoint}_event'] = has_event.astype(int)
+
+        return df
+
+
+class TrialData(ParticipantData):
+    """
+    Class representing the participants of a simulated trial of the four-state model of the article in compact columns:
+    event times in the smallest unsigned integer type holding the duration (time 0 means no event) and a boolean arm
+    indicator, with the treatment arm first. Participant ids and the data frame are only built on request.
+    """
+    def __init__(self, treated, progress_time, death_time, censor_time, duration):
+        time_type = np.min_scalar_type(duration)
+
+        self.duration = duration
+        self.treated = np.asarray(treated, dtype=bool)
+        self.progress_time = np.asarray(progress_time).astype(time_type, copy=False)
+        self.death_time = np.asarray(death_time).astype(time_type, copy=False)
+        self.censor_time = np.asarray(censor_time).astype(time_type, copy=False)
+
+    @classmethod
+    def from_arms(cls, treatment_group, control_group, duration):
+        def concatenate(times_treatment, times_control):
+            return np.concatenate([times_treatment, times_control], dtype=np.min_scalar_type(duration), casting='unsafe')
+
+        return cls(
+            np.repeat([True, False], [treatment_group.state.size, control_group.state.size]),
+            concatenate(treatment_group.progress_time, control_group.progress_time),
+            concatenate(treatment_group.death_time, control_group.death_time),
+            concatenate(treatment_group.censor_time, control_group.censor_time),
+            duration,
+        )
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Participants of a data frame as returned by simulate_trial or to_frame
+        """
+        def as_times(times):
+            return np.nan_to_num(times.to_numpy(), nan=0)
+
+        return cls(df['group'].to_numpy() == 1, as_times(df['t_progression']), as_times(df['t_death']), as_times(df['t_censor']), int(df['duration'].iloc[0]))
+
+    def get_endpoint(self, endpoint):
+        """
+        Time of the event or of the end of follow-up and whether an event occurred for every participant, for the
+        endpoint 'pfs' or 'os'
+        """
+        if endpoint == 'pfs':
+            # censoring ends the follow-up of PFS before any later progression or death
+            event_time = np.where(self.censor_time > 0, self.censor_time, np.where(self.progress_time > 0, self.progress_time, self.death_time))
+            has_event = (self.censor_time == 0) & (event_time > 0)
+        else:
+            event_time = self.death_time
+            has_event = event_time > 0
+
+        return np.where(event_time > 0, event_time, self.duration), has_event
+
+    @instrument('frame', get_fields=lambda arguments: {'n': len(arguments['self'])})
+    def to_frame(self):
+        """
+        One row per participant with the columns returned by simulate_trial
+        """
+        def as_times(times):
+            return np.where(times > 0, times, np.nan)
+
+        df = pd.DataFrame({
+            'participant': self.get_participant_ids(),
+            'group': self.treated.astype(int),
+            't_progression': as_times(self.progress_time),
+            't_death': as_times(self.death_time),
+            't_censor': as_times(self.censor_time),
+            'duration': self.duration,
+        })
+
+        for endpoint in ['pfs', 'os']:
+            event_time, has_event = self.get_endpoint(endpoint)
+            df[f'{endpoint}_event_time'] = event_time.astype(float)
+            df[f'has_{endpoint}_event'] = has_event.astype(int)
+
+        return df
+
+
+def get_study_arm(participants):
+    """
+    StudyArm with the states and event times of a list of StudyParticipant
+    """
+    arm = StudyArm(len(participants))
+    arm.state[:] = [STATES.index(participant.state) for participant in participants]
+    arm.progress_time[:] = [participant.progress_time or 0 for participant in participants]
+    arm.death_time[:] = [participant.death_time or 0 for participant in participants]
+    arm.censor_time[:] = [participant.censor_time or 0 for participant in participants]
+
+    return arm
+
+
+def get_study_args(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c):
+    return dict(
         n=n,
         duration=duration,
         p_progression_treatment=p_progression_t,
@@ -127,79 +846,982 @@ def simulate_trial(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_
         p_death_given_censor_control = p_death_given_censor_c
     )
 
+
+def get_arm_params(p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c):
+    """
+    Transition probabilities of the treatment and the control arm in the argument order of get_transition_matrix
+    """
+    return (
+        (p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t),
+        (p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c),
+    )
+
+
+def simulate_trial(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, engine='study', seed=None, coupling=None):
+    """
+    Simulates a trial with n participants per arm. Returns one row per participant, except for the 'cohort' engine which
+    only tracks the number of participants per state and returns a life table with one row per arm and period.
+    See simulate_trial_data for coupling.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown engine {engine!r}, expected one of {ENGINES}')
+
+    if engine == 'cohort':
+        if coupling is not None:
+            raise ValueError(f'Coupling is only supported by the direct engine, not by {engine!r}')
+
+        with measure_stage('simulate', n=n, duration=duration, engine=engine):
+            rng = np.random.default_rng(seed)
+            return get_trial_life_table(
+                simulate_cohort_arm(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, rng),
+                simulate_cohort_arm(n, duration, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, rng),
+            )
+
+    return simulate_trial_data(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, engine=engine, seed=seed, coupling=coupling).to_frame()
+
+
+@instrument('simulate', arguments=['n', 'duration', 'engine'])
+def simulate_trial_data(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, engine='study', seed=None, coupling=None):
+    """
+    Simulates a trial with n participants per arm with one of the engines in PARTICIPANT_ENGINES and returns its
+    participants as TrialData.
+    With coupling, the 'direct' engine drives both arms from the same uniforms per participant slot ('common'), and
+    additionally pairs every slot with a mirrored one ('antithetic'), see draw_uniforms. The uniforms only depend on n
+    and the seed, so scenarios simulated with the same seed share them as well and the differences of their estimates
+    are far less noisy. The arms of a coupled trial are not independent, so only the estimates are meaningful, not their
+    standard errors or p-values.
+    """
+    if engine not in PARTICIPANT_ENGINES:
+        raise ValueError(f'Unknown engine {engine!r}, expected one of {PARTICIPANT_ENGINES}')
+
+    if coupling is not None and (engine != 'direct' or coupling not in COUPLINGS):
+        raise ValueError(f'Unknown coupling {coupling!r} for engine {engine!r}, the direct engine supports {COUPLINGS}')
+
+    study_args = get_study_args(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c)
+
+    if engine == 'direct':
+        rng = np.random.default_rng(seed)
+        uniforms = draw_uniforms(n, rng, antithetic=coupling == 'antithetic') if coupling is not None else None
+        treatment_group = sample_arm(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, rng, uniforms=uniforms)
+        control_group = sample_arm(n, duration, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, rng, uniforms=uniforms)
+    else:
+        if engine == 'numpy':
+            study = VectorizedStudy(**study_args, rng=np.random.default_rng(seed))
+        else:
+            study = Study(**study_args)
+            if seed is not None:
+                random.seed(seed)
+
+        while not study.complete:
+            study.simulate_period()
+
+        treatment_group, control_group = study.get_treatment_group(), study.get_control_group()
+        if engine == 'study':
+            treatment_group, control_group = get_study_arm(treatment_group), get_study_arm(control_group)
+
+    return TrialData.from_arms(treatment_group, control_group, duration)
+
+
+def simulate_transitions(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, engine='numpy', seed=None):
+    """
+    Simulates a trial with n participants per arm and yields the transitions of each period as soon as it is drawn, as
+    returned by get_transition_data. Consumers can write or aggregate the chunks while the trial is running and stop early.
+    """
+    if engine not in STREAMING_ENGINES:
+        raise ValueError(f'Unknown engine {engine!r}, expected one of {STREAMING_ENGINES}')
+
+    study_args = get_study_args(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c)
+
+    if engine == 'numpy':
+        study = VectorizedStudy(**study_args, rng=np.random.default_rng(seed))
+    else:
+        study = Study(**study_args)
+        if seed is not None:
+            random.seed(seed)
+
+    yield from study.iter_transitions()
+
+
+@instrument('simulate', arguments=['n', 'duration'])
+def simulate_model(model, n, duration, seed=None):
+    """
+    Simulates a trial with n participants per arm from a MultiStateModel. Returns the participants as ModelTrialData,
+    see to_frame for one row per participant.
+    """
+    study = MultiStateStudy(model, n, duration, rng=np.random.default_rng(seed))
     while not study.complete:
         study.simulate_period()
 
-    data_treatment = [{
-        'participant': f't_{id}', 
-        'group': 1, 
-        't_progression': participant.progress_time,
-        't_death': participant.death_time,
-        't_censor': participant.censor_time,
-        } for id, participant in enumerate(study.get_treatment_group())
-    ]
+    return ModelTrialData.from_arms(model, study.get_treatment_group(), study.get_control_group(), duration)
+
+
+def get_survival(at_risk, events):
+    """
+    Kaplan-Meier survival at the end of each period from the numbers at risk and the events per period, batched over
+    the leading dimensions
+    """
+    hazard = np.divide(events, at_risk, out=np.zeros(np.shape(events)), where=np.asarray(at_risk) > 0)
+    return np.cumprod(1 - hazard, axis=-1)
+
+
+def get_greenwood_band(at_risk, events, survival, alpha=0.05):
+    """
+    Pointwise confidence band at level 1 - alpha of Kaplan-Meier survival from Greenwood's variance, computed on the
+    log(-log) scale like lifelines' KaplanMeierFitter
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # periods in which everybody at risk has an event add no variance
+        variance = np.cumsum(np.nan_to_num(events / (at_risk * (at_risk - events)), posinf=0), axis=-1)
+
+        log_survival = np.log(survival)
+        z = ndtri(1 - alpha / 2)
+        lower = np.exp(-np.exp(np.log(-log_survival) - z * np.sqrt(variance) / log_survival))
+        upper = np.exp(-np.exp(np.log(-log_survival) + z * np.sqrt(variance) / log_survival))
 
-    data_control = [{
-        'participant': f'c_{id}', 
-        'group': 0, 
-        't_progression': participant.progress_time,
-        't_death': participant.death_time,
-        't_censor': participant.censor_time,
-        } for id, participant in enumerate(study.get_control_group())
-    ]
+    # the band is undefined while survival is still 1
+    return np.nan_to_num(lower, nan=1), np.nan_to_num(upper, nan=1)
 
-    data_all = data_treatment + data_control
 
-    df = pd.DataFrame(data_all)
+def get_arm_counts(occupancy, flows):
+    """
+    Numbers at risk, events and censorings per period for both endpoints of an arm, from the number of participants per
+    state at the end of each period (starting with period 0) and the flows between states in each period, flows[t, ..., i, j]
+    going from state i to state j. Any dimensions between time and state (e.g. replicate trials) are kept.
+    """
+    no_progression, progressed, censored, dead = [STATES.index(state) for state in (NO_PROGRESSION, PROGRESSED, CENSORED, DEAD)]
 
-    df['duration'] = duration
+    # at risk are the participants in the respective states at the start of each period
+    at_risk_pfs = occupancy[:-1, ..., no_progression]
+    at_risk_os = occupancy[:-1, ..., :dead].sum(axis=-1)
 
-    df['pfs_event_time'] = df['t_censor'].combine_first(df['t_progression']).combine_first(df['t_death']).combine_first(df['duration'])
-    df['has_pfs_event'] = df.apply(lambda x: 0 if pd.notna(x['t_censor']) or (pd.isna(x['t_censor']) and pd.isna(x['t_progression']) and pd.isna(x['t_death'])) else 1, axis=1)
+    events_pfs = flows[..., no_progression, progressed] + flows[..., no_progression, dead]
+    censored_pfs = flows[..., no_progression, censored].copy()
+    events_os = flows[..., :dead, dead].sum(axis=-1)
+    censored_os = np.zeros_like(events_os)
 
-    df['os_event_time'] = df['t_death'].combine_first(df['duration'])
-    df['has_os_event'] = df['t_death'].apply(lambda x: 1 if pd.notna(x) else 0)
+    # participants still at risk at the end of the trial are censored administratively
+    censored_pfs[-1] = at_risk_pfs[-1] - events_pfs[-1]
+    censored_os[-1] = at_risk_os[-1] - events_os[-1]
 
-    return df
+    return {
+        'at_risk_pfs': at_risk_pfs,
+        'events_pfs': events_pfs,
+        'censored_pfs': censored_pfs,
+        'at_risk_os': at_risk_os,
+        'events_os': events_os,
+        'censored_os': censored_os,
+    }
+
+
+def get_arm_life_table(occupancy, flows):
+    """
+    Life table of an arm from the state occupancy and flows as taken by get_arm_counts
+    """
+    return pd.DataFrame({
+        'time': np.arange(1, len(flows) + 1),
+        **get_arm_counts(occupancy, flows),
+        'no_progression': occupancy[1:, STATES.index(NO_PROGRESSION)],
+        'progressed': occupancy[1:, STATES.index(PROGRESSED)],
+        'censored': occupancy[1:, STATES.index(CENSORED)],
+        'dead': occupancy[1:, STATES.index(DEAD)],
+    })
+
+
+def get_trial_life_table(life_table_treatment, life_table_control):
+    life_tables = []
+    for group, life_table in [(1, life_table_treatment), (0, life_table_control)]:
+        life_table.insert(0, 'group', group)
+        life_table['pfs_survival'] = get_survival(life_table['at_risk_pfs'].values, life_table['events_pfs'].values)
+        life_table['os_survival'] = get_survival(life_table['at_risk_os'].values, life_table['events_os'].values)
+        life_tables.append(life_table)
+
+    return pd.concat(life_tables, ignore_index=True)
+
+
+def solve_arm(n, duration, p_progression, p_death, p_censor, p_death_given_progression, p_death_given_censor):
+    """
+    Expected life table of an arm with n participants, obtained by propagating the distribution over STATES through the
+    transition matrix instead of simulating participants
+    """
+    transitions = get_transition_matrix(p_progression, p_death, p_censor, p_death_given_progression, p_death_given_censor)
+
+    occupancy = np.zeros((duration + 1, len(STATES)))
+    occupancy[0, STATES.index(NO_PROGRESSION)] = n
+    flows = np.zeros((duration, len(STATES), len(STATES)))
+    for t in range(duration):
+        flows[t] = occupancy[t][:, None] * transitions
+        occupancy[t + 1] = flows[t].sum(axis=0)
+
+    return get_arm_life_table(occupancy, flows)
+
+
+def draw_cohort_flows(n, duration, transitions, rng, replicates=None):
+    """
+    Number of participants per state at the end of each period (starting with period 0) and flows between states in each
+    period for a cohort of n participants, drawn from multinomial distributions over the rows of the transition matrix.
+    With replicates, independent cohorts are drawn in one batch along a second axis.
+    """
+    shape = () if replicates is None else (replicates,)
+
+    occupancy = np.zeros((duration + 1,) + shape + (len(STATES),), dtype=np.int64)
+    occupancy[0, ..., STATES.index(NO_PROGRESSION)] = n
+    flows = np.zeros((duration,) + shape + (len(STATES), len(STATES)), dtype=np.int64)
+    for t in range(duration):
+        flows[t] = rng.multinomial(occupancy[t], transitions)
+        occupancy[t + 1] = flows[t].sum(axis=-2)
+
+    return occupancy, flows
+
+
+def get_arm_flows(arm, duration):
+    """
+    State occupancy and flows between states per period of a simulated StudyArm, in the form returned by
+    draw_cohort_flows. Both are sums over participants, so the results of separately simulated blocks can be added up.
+    """
+    no_progression, progressed, censored, dead = [STATES.index(state) for state in (NO_PROGRESSION, PROGRESSED, CENSORED, DEAD)]
+
+    def count(times):
+        # time 0 collects the participants without the event and is dropped
+        return np.bincount(times, minlength=duration + 1)[1:]
+
+    flows = np.zeros((duration, len(STATES), len(STATES)), dtype=np.int64)
+    flows[:, no_progression, progressed] = count(arm.progress_time)
+    flows[:, no_progression, censored] = count(arm.censor_time)
+
+    death_from = np.where(arm.progress_time > 0, progressed, np.where(arm.censor_time > 0, censored, no_progression))
+    for state in (no_progression, progressed, censored):
+        flows[:, state, dead] = count(arm.death_time[death_from == state])
+
+    return get_occupancy(flows, arm.state.size), flows
+
+
+def get_occupancy(flows, n):
+    """
+    State occupancy per period of an arm of n participants from the flows between different states, as in
+    draw_cohort_flows. The participants staying in their state are filled into the diagonal of flows in place.
+    """
+    occupancy = np.zeros((len(flows) + 1, len(STATES)), dtype=np.int64)
+    occupancy[0, STATES.index(NO_PROGRESSION)] = n
+    occupancy[1:] = occupancy[0] + np.cumsum(flows.sum(axis=-2) - flows.sum(axis=-1), axis=0)
+
+    states = np.arange(len(STATES))
+    flows[:, states, states] = occupancy[:-1] - flows.sum(axis=-1)
+
+    return occupancy
+
+
+def get_coupled_arm_flows(duration, p_progression, p_death, p_censor, p_death_given_progression, p_death_given_censor, uniforms, log_uniforms):
+    """
+    State occupancy and flows of the arm that sample_arm draws from uniforms, as get_arm_flows returns them, but counted
+    without recording the participants and with log1p(-uniforms) computed once by the caller. This keeps the many arms
+    simulated from the same uniforms in get_sensitivities cheap.
+    """
+    no_progression, progressed, censored, dead = [STATES.index(state) for state in (NO_PROGRESSION, PROGRESSED, CENSORED, DEAD)]
 
-def get_hr(data, time_col, event_col, group_col):
-        cph = CoxPHFitter()
-        data_fit = data[[time_col, event_col, group_col]]
-        cph.fit(data_fit, duration_col=time_col, event_col=event_col)
-        hr = float(cph.hazard_ratios_.iloc[0])  
+    def get_waiting_times(p, log_u):
+        # as draw_waiting_times, with never leaving the state represented by the period after the trial
+        if p <= 0:
+            return np.full(log_u.size, duration + 1)
+        if p >= 1:
+            return np.ones(log_u.size, dtype=np.int64)
+        return np.maximum(np.ceil(log_u / np.log1p(-p)), 1)
+
+    def count(times):
+        return np.bincount(times.astype(np.int64), minlength=duration + 1)[1:duration + 1]
+
+    p_exit = p_progression + p_death + p_censor
+    exit_time = get_waiting_times(p_exit, log_uniforms[0])
+    exited = np.flatnonzero(exit_time <= duration)
+    exit_time = exit_time[exited]
+
+    u = uniforms[1][exited] * p_exit
+    is_progressed = u < p_progression
+    is_censored = ~is_progressed & (u < p_progression + p_censor)
+
+    flows = np.zeros((duration, len(STATES), len(STATES)), dtype=np.int64)
+    flows[:, no_progression, dead] = count(exit_time[~is_progressed & ~is_censored])
+    for state, p_death_given_state, in_state in [
+        (progressed, p_death_given_progression, is_progressed),
+        (censored, p_death_given_censor, is_censored),
+    ]:
+        entry_time = exit_time[in_state]
+        flows[:, no_progression, state] = count(entry_time)
+
+        death_time = entry_time + get_waiting_times(p_death_given_state, log_uniforms[2][exited[in_state]])
+        flows[:, state, dead] = count(death_time[death_time <= duration])
+
+    return get_occupancy(flows, uniforms.shape[1]), flows
+
+
+def simulate_cohort_arm(n, duration, p_progression, p_death, p_censor, p_death_given_progression, p_death_given_censor, rng):
+    """
+    Life table of a simulated arm with n participants, drawing the number of participants moving between STATES in each
+    period from multinomial distributions instead of simulating individual participants
+    """
+    transitions = get_transition_matrix(p_progression, p_death, p_censor, p_death_given_progression, p_death_given_censor)
+
+    return get_arm_life_table(*draw_cohort_flows(n, duration, transitions, rng))
+
+
+@instrument('solve', arguments=['n', 'duration'])
+def solve_trial(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c):
+    """
+    Exact expected outcome of a trial with n participants per arm, i.e. the limit of simulate_trial for large n.
+    Returns a life table with one row per arm and period, including the expected PFS and OS survival curves.
+    """
+    return get_trial_life_table(
+        solve_arm(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t),
+        solve_arm(n, duration, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c),
+    )
+
+
+def is_life_table(data):
+    return isinstance(data, pd.DataFrame) and 'at_risk_pfs' in data.columns
+
+
+def get_weighted_events(life_table, endpoint):
+    """
+    Rows of (time, event, group, weight) with the number of events and censorings per arm and period of a life table
+    """
+    rows = []
+    for event, count_col in [(1, f'events_{endpoint}'), (0, f'censored_{endpoint}')]:
+        rows.append(pd.DataFrame({
+            'time': life_table['time'],
+            'event': event,
+            'group': life_table['group'],
+            'weight': life_table[count_col],
+        }))
+
+    rows = pd.concat(rows, ignore_index=True)
+    return rows[rows['weight'] > 0]
+
+
+@instrument('kaplan_meier', get_fields=get_data_fields)
+def get_kaplan_meier(data, time_col, event_col, group_col, weights_col=None, alpha=None):
+    """
+    Kaplan-Meier curves of group 1 and group 0 with one row per group and distinct time at which the group is still at
+    risk. With alpha, the curves come with a pointwise confidence band at level 1 - alpha, see get_greenwood_band.
+    """
+    if weights_col is None:
+        data, weights_col = aggregate_events(data, time_col, event_col, group_col), 'weight'
+
+    times = np.unique(data[time_col].values)
+    at_risk, events = get_risk_sets(data, time_col, event_col, group_col, weights_col)
+
+    curves = {
+        'group': np.repeat([1, 0], times.size),
+        'time': np.tile(times, 2),
+        'at_risk': at_risk[::-1].ravel(),
+        'events': events[::-1].ravel(),
+        'survival': get_survival(at_risk, events)[::-1].ravel(),
+    }
+    if alpha is not None:
+        lower, upper = get_greenwood_band(at_risk, events, get_survival(at_risk, events), alpha=alpha)
+        curves['survival_lower'] = lower[::-1].ravel()
+        curves['survival_upper'] = upper[::-1].ravel()
+
+    curves = pd.DataFrame(curves)
+    return curves[curves['at_risk'] > 0].reset_index(drop=True)
+
+
+def aggregate_events(data, time_col, event_col, group_col):
+    """
+    Collapses participant rows into one row per distinct (time, event, group) with the number of participants as weight
+    """
+    return data.groupby([time_col, event_col, group_col]).size().rename('weight').reset_index()
+
+
+def get_risk_sets(data, time_col, event_col, group_col, weights_col):
+    """
+    Numbers at risk and events at each distinct time of weighted rows, as arrays of shape (2, times) indexed by group
+    """
+    times, time_index = np.unique(data[time_col].values, return_inverse=True)
+    group = data[group_col].values.astype(int)
+    weight = data[weights_col].values.astype(float)
+    event = data[event_col].values == 1
+
+    leaving = np.zeros((2, times.size))
+    events = np.zeros((2, times.size))
+    np.add.at(leaving, (group, time_index), weight)
+    np.add.at(events, (group[event], time_index[event]), weight[event])
+
+    # everyone with an event or censoring at or after a time is at risk at that time
+    at_risk = np.cumsum(leaving[:, ::-1], axis=1)[:, ::-1]
+
+    return at_risk, events
+
+
+def fit_cox(at_risk, events, ties='efron', tolerance=1e-9, max_iterations=50):
+    """
+    Maximizes the Cox partial likelihood for the binary group covariate by Newton-Raphson, using only the numbers at
+    risk and events per arm at each distinct time. at_risk and events have shape (2, ..., times), indexed by group first;
+    any dimensions in between (e.g. replicate trials) are fitted in one batch.
+
+    With Efron's tie correction the sum over the tied events at each time is expressed with the log-gamma function, so it
+    costs the same for any number of ties and gives the same estimate as a fit on one row per participant.
+    Returns the log hazard ratio of group 1 versus group 0 and its standard error.
+    """
+    if ties not in TIES:
+        raise ValueError(f'Unknown tie handling {ties!r}, expected one of {TIES}')
+
+    (r0, r1), (e0, e1) = np.asarray(at_risk, dtype=float), np.asarray(events, dtype=float)
+    d = e0 + e1
+    k = r1 * e0 - r0 * e1
+
+    beta = np.zeros(d.shape[:-1])
+    for _ in range(max_iterations):
+        w = np.exp(beta)[..., None]
+        r = r0 + r1 * w
+
+        if ties == 'breslow':
+            score = (e1 - d * r1 * w / r).sum(axis=-1)
+            information = (d * r0 * r1 * w / r ** 2).sum(axis=-1)
+        else:
+            # times without events contribute nothing, a tied sum of one keeps their terms finite
+            tied = np.where(d > 0, e0 + e1 * w, 1)
+
+            # Efron: sum over j < d of log(r - j / d * tied) = d * log(tied / d) + lgamma(a + 1) - lgamma(a - d + 1)
+            a = d * r / tied
+            da = d * w * k / tied ** 2
+            dda = d * w * k * (tied - 2 * e1 * w) / tied ** 3
+            digamma_diff = digamma(a + 1) - digamma(a - d + 1)
+            trigamma_diff = polygamma(1, a + 1) - polygamma(1, a - d + 1)
+
+            score = (e1 - d * e1 * w / tied - da * digamma_diff).sum(axis=-1)
+            information = (d * e0 * e1 * w / tied ** 2 + dda * digamma_diff + da ** 2 * trigamma_diff).sum(axis=-1)
+
+        step = np.clip(np.divide(score, information, out=np.zeros_like(beta), where=information > 0), -1, 1)
+        beta = beta + step
+        if np.all(np.abs(step) < tolerance):
+            break
+
+    se = np.divide(1, np.sqrt(information), out=np.full_like(beta, np.inf), where=information > 0)
+
+    return beta, se
+
+
+def estimate_hazard_ratio(at_risk, events, ties='efron', alpha=0.05):
+    """
+    Hazard ratio of group 1 versus group 0 with the standard error of its logarithm, a Wald confidence interval at level
+    1 - alpha and the Wald test p-value, from the numbers at risk and events per arm as taken by fit_cox
+    """
+    log_hr, se = fit_cox(at_risk, events, ties=ties)
+    z = ndtri(1 - alpha / 2)
+
+    return {
+        'hr': np.exp(log_hr),
+        'se': se,
+        'ci_lower': np.exp(log_hr - z * se),
+        'ci_upper': np.exp(log_hr + z * se),
+        'p': 2 * ndtr(-np.abs(log_hr / se)),
+    }
+
+
+def get_hr_estimate(data, time_col, event_col, group_col, weights_col=None, ties='efron', alpha=0.05):
+    if weights_col is None:
+        data, weights_col = aggregate_events(data, time_col, event_col, group_col), 'weight'
+
+    at_risk, events = get_risk_sets(data, time_col, event_col, group_col, weights_col)
+
+    return {key: float(value) for key, value in estimate_hazard_ratio(at_risk, events, ties=ties, alpha=alpha).items()}
+
+
+@instrument('hazard_ratio', arguments=['backend', 'ties'], get_fields=get_data_fields)
+def get_hr(data, time_col, event_col, group_col, weights_col=None, backend='native', ties='efron'):
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown backend {backend!r}, expected one of {BACKENDS}')
+
+        if backend == 'lifelines':
+            from lifelines import CoxPHFitter
+
+            cph = CoxPHFitter()
+            data_fit = data[[time_col, event_col, group_col] + ([weights_col] if weights_col else [])]
+            cph.fit(data_fit, duration_col=time_col, event_col=event_col, weights_col=weights_col)
+            hr = float(cph.hazard_ratios_.iloc[0])
+
+            return hr
+
+        hr = get_hr_estimate(data, time_col, event_col, group_col, weights_col=weights_col, ties=ties)['hr']
 
         return hr
 
-def get_hazard_ratio_pfs(df):
-    hr_pfs = get_hr(df, 'pfs_event_time', 'has_pfs_event', 'group')
+def get_hazard_ratio_pfs(df, backend='native'):
+    if is_life_table(df):
+        return get_hr(get_weighted_events(df, 'pfs'), 'time', 'event', 'group', weights_col='weight', backend=backend)
+
+    if isinstance(df, ParticipantData):
+        return get_hr(df.get_weighted_events('pfs'), 'time', 'event', 'group', weights_col='weight', backend=backend)
+
+    hr_pfs = get_hr(df, 'pfs_event_time', 'has_pfs_event', 'group', backend=backend)
 
     return hr_pfs
 
-def get_hazard_ratio_os(df):
-    hr_os = get_hr(df, 'os_event_time', 'has_os_event', 'group')
+def get_hazard_ratio_os(df, backend='native'):
+    if is_life_table(df):
+        return get_hr(get_weighted_events(df, 'os'), 'time', 'event', 'group', weights_col='weight', backend=backend)
+
+    if isinstance(df, ParticipantData):
+        return get_hr(df.get_weighted_events('os'), 'time', 'event', 'group', weights_col='weight', backend=backend)
+
+    hr_os = get_hr(df, 'os_event_time', 'has_os_event', 'group', backend=backend)
 
     return hr_os
 
-def plot_kaplan_meier(data, time_col, event_col, group_col):
-    kmf = KaplanMeierFitter()
+@instrument('replicates', arguments=['replicates', 'n', 'duration'])
+def simulate_replicates(replicates, n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, seed=None, ties='efron'):
+    """
+    Simulates independent replicate trials of one parameter set in a single batch. Like the 'cohort' engine, only the
+    number of participants per state is tracked, with an additional replicate axis, and the Cox models of all replicates
+    are fitted together. Returns one row per replicate with the PFS and OS hazard ratios, their ratio, the standard errors
+    and p-values and the number of events.
+    """
+    rng = np.random.default_rng(seed)
+
+    counts = {}
+    for group, params in [
+        (1, (p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t)),
+        (0, (p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c)),
+    ]:
+        occupancy, flows = draw_cohort_flows(n, duration, get_transition_matrix(*params), rng, replicates)
+        counts[group] = get_arm_counts(occupancy, flows)
+
+    results = {'replicate': np.arange(replicates)}
+    for endpoint in ['pfs', 'os']:
+        # shape (2, replicates, times) indexed by group as taken by fit_cox
+        at_risk = np.stack([counts[group][f'at_risk_{endpoint}'].T for group in (0, 1)])
+        events = np.stack([counts[group][f'events_{endpoint}'].T for group in (0, 1)])
+
+        estimate = estimate_hazard_ratio(at_risk, events, ties=ties)
+        results[f'hr_{endpoint}'] = estimate['hr']
+        results[f'se_{endpoint}'] = estimate['se']
+        results[f'p_{endpoint}'] = estimate['p']
+        results[f'events_{endpoint}'] = events.sum(axis=(0, 2))
+
+    df = pd.DataFrame(results)
+    df['hr_ratio'] = df['hr_pfs'] / df['hr_os']
+
+    return df
+
+
+def summarize_replicates(df, quantiles=QUANTILES):
+    """
+    Mean, standard deviation and quantiles of the hazard ratios over the replicates of simulate_replicates
+    """
+    columns = ['hr_pfs', 'hr_os', 'hr_ratio']
+
+    summary_quantiles = df[columns].quantile(quantiles)
+    summary_quantiles.index = [f'q{q:g}' for q in quantiles]
+
+    return pd.concat([df[columns].agg(['mean', 'std']), summary_quantiles])
+
+
+@instrument('sensitivity', arguments=['n', 'duration'])
+def get_sensitivities(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, seed=None, step=SENSITIVITY_STEP, absolute_step=SENSITIVITY_ABSOLUTE_STEP, ties='efron'):
+    """
+    Sensitivity of the PFS and OS hazard ratios and their ratio to each of the ten transition probabilities, by central
+    differences: every probability in turn is scaled by 1 + step and 1 - step. A probability of zero cannot be scaled
+    and is raised to absolute_step instead, a forward difference against the base trial. All perturbed trials are simulated with
+    the 'direct' engine from the same uniforms per participant slot (see draw_uniforms), so their differences hardly
+    contain any sampling noise, and the Cox models of all of them are fitted in one batch. A probability of one arm does
+    not affect the other arm, which is simulated only once for the base trial, so the batch costs 22 arm simulations.
+    Returns one row per probability with its value, the kind of difference ('central' or 'forward'), the elasticities
+    d log HR / d log p (undefined for a probability of zero) and the derivatives d HR / d p.
+    """
+    arm_params = get_arm_params(p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c)
+    names = [f'{param}_{suffix}' for suffix in ('t', 'c') for param in ARM_PARAMS]
+    values = dict(zip(names, arm_params[0] + arm_params[1]))
+
+    # the upper and lower value of every probability; the lower value of a probability of zero is the base trial, which
+    # is simulated only once like every other repeated arm
+    perturbations = [(value * (1 + step), value * (1 - step)) if value > 0 else (absolute_step, 0) for value in values.values()]
+
+    # scenario 0 is the base trial, followed by every probability at its upper and lower value; each holds the
+    # parameters per arm
+    scenarios = [arm_params]
+    for arm, params in enumerate(arm_params):
+        for index in range(len(ARM_PARAMS)):
+            name = names[arm * len(ARM_PARAMS) + index]
+            for value in perturbations[arm * len(ARM_PARAMS) + index]:
+                perturbed = params[:index] + (value,) + params[index + 1:]
+                if max(perturbed) > 1 or sum(perturbed[:3]) > 1:
+                    raise ValueError(f'Perturbing {name} to {value:g} gives invalid transition probabilities {perturbed}')
+                scenarios.append(arm_params[:arm] + (perturbed,) + arm_params[arm + 1:])
+
+    uniforms = draw_uniforms(n, np.random.default_rng(seed))
+    log_uniforms = np.log1p(-uniforms)
+
+    arm_flows = {}
+    counts = {}
+    for group, arm in [(1, 0), (0, 1)]:
+        for scenario in scenarios:
+            if scenario[arm] not in arm_flows:
+                arm_flows[scenario[arm]] = get_coupled_arm_flows(duration, *scenario[arm], uniforms, log_uniforms)
+
+        # shape (times + 1, scenarios, states) and (times, scenarios, states, states) as taken by get_arm_counts
+        occupancy = np.stack([arm_flows[scenario[arm]][0] for scenario in scenarios], axis=1)
+        flows = np.stack([arm_flows[scenario[arm]][1] for scenario in scenarios], axis=1)
+        counts[group] = get_arm_counts(occupancy, flows)
+
+    log_hrs = {}
+    for endpoint in ['pfs', 'os']:
+        at_risk = np.stack([counts[group][f'at_risk_{endpoint}'].T for group in (0, 1)])
+        events = np.stack([counts[group][f'events_{endpoint}'].T for group in (0, 1)])
+        log_hrs[endpoint], _ = fit_cox(at_risk, events, ties=ties)
+    log_hrs['ratio'] = log_hrs['pfs'] - log_hrs['os']
+
+    value = np.array(list(values.values()))
+    value_up, value_down = np.array(perturbations).T
+    results = {'parameter': names, 'value': value, 'difference': np.where(value > 0, 'central', 'forward')}
+    for quantity, log_hr in log_hrs.items():
+        log_hr_up, log_hr_down = log_hr[1::2], log_hr[2::2]
+        # the logarithm of a probability of zero is undefined, and so is its elasticity
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results[f'elasticity_{quantity}'] = np.where(value > 0, (log_hr_up - log_hr_down) / (np.log(value_up) - np.log(value_down)), np.nan)
+        results[f'derivative_{quantity}'] = (np.exp(log_hr_up) - np.exp(log_hr_down)) / (value_up - value_down)
+
+    return pd.DataFrame(results).set_index('parameter')
+
+
+def simulate_shard(n, duration, probabilities, seed_sequence, engine):
+    """
+    Simulates a block of n participants per arm and reduces it to the state occupancy and flows per arm
+    """
+    rng = np.random.default_rng(seed_sequence)
+
+    if engine == 'direct':
+        params_t, params_c = get_arm_params(**probabilities)
+        treatment_group = sample_arm(n, duration, *params_t, rng)
+        control_group = sample_arm(n, duration, *params_c, rng)
+    else:
+        study = VectorizedStudy(**get_study_args(n, duration, **probabilities), rng=rng)
+        while not study.complete:
+            study.simulate_period()
+        treatment_group, control_group = study.get_treatment_group(), study.get_control_group()
+
+    return get_arm_flows(treatment_group, duration), get_arm_flows(control_group, duration)
+
+
+def get_shards(n, shard_size, seed):
+    """
+    Participants per arm and independent seed sequence of each shard of a trial with n participants per arm
+    """
+    shard_sizes = [min(shard_size, n - start) for start in range(0, n, shard_size)]
+    return shard_sizes, np.random.SeedSequence(seed).spawn(len(shard_sizes))
+
+
+def add_shards(shards):
+    """
+    Sums the state occupancy and flows per arm of the shards of a trial into the life table of the whole trial
+    """
+    (occupancy_t, flows_t), (occupancy_c, flows_c) = reduce(
+        lambda total, shard: tuple((a[0] + b[0], a[1] + b[1]) for a, b in zip(total, shard)), shards
+    )
+
+    return get_trial_life_table(get_arm_life_table(occupancy_t, flows_t), get_arm_life_table(occupancy_c, flows_c))
+
+
+@instrument('simulate_parallel', arguments=['n', 'duration', 'engine', 'workers', 'shard_size'])
+def simulate_trial_parallel(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, engine='direct', seed=None, workers=None, shard_size=None):
+    """
+    Simulates one large trial with the participants of both arms split into shards that run in a process pool, each with
+    its own independent random stream. Shards only return their state occupancy and flows, which are summed into the
+    life table of the whole trial. For a given seed and shard_size the result does not depend on the number of workers.
+    Scripts using this on platforms that spawn worker processes need an if __name__ == '__main__' guard.
+    """
+    if engine not in PARALLEL_ENGINES:
+        raise ValueError(f'Unknown engine {engine!r}, expected one of {PARALLEL_ENGINES}')
+
+    workers = workers or os.cpu_count()
+    shard_size = shard_size or min(CHUNK_SIZE, -(-n // workers))
+    shard_sizes, seed_sequences = get_shards(n, shard_size, seed)
+
+    probabilities = dict(
+        p_progression_t=p_progression_t, p_death_t=p_death_t, p_censor_t=p_censor_t, p_death_given_progression_t=p_death_given_progression_t, p_death_given_censor_t=p_death_given_censor_t,
+        p_progression_c=p_progression_c, p_death_c=p_death_c, p_censor_c=p_censor_c, p_death_given_progression_c=p_death_given_progression_c, p_death_given_censor_c=p_death_given_censor_c
+    )
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return add_shards(executor.map(simulate_shard, shard_sizes, repeat(duration), repeat(probabilities), seed_sequences, repeat(engine)))
+
+
+@instrument('simulate_chunked', arguments=['n', 'duration', 'engine', 'chunk_size'])
+def simulate_trial_chunked(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, engine='direct', seed=None, chunk_size=CHUNK_SIZE):
+    """
+    Simulates one large trial in a single process in chunks of chunk_size participants per arm. Each chunk is reduced to
+    its state occupancy and flows per period, the sufficient statistics of the life table, and discarded, so the memory
+    use is bounded by chunk_size instead of n. Returns the same life table as simulate_trial_parallel with shard_size
+    equal to chunk_size.
+    """
+    if engine not in PARALLEL_ENGINES:
+        raise ValueError(f'Unknown engine {engine!r}, expected one of {PARALLEL_ENGINES}')
+
+    shard_sizes, seed_sequences = get_shards(n, chunk_size, seed)
+
+    probabilities = dict(
+        p_progression_t=p_progression_t, p_death_t=p_death_t, p_censor_t=p_censor_t, p_death_given_progression_t=p_death_given_progression_t, p_death_given_censor_t=p_death_given_censor_t,
+        p_progression_c=p_progression_c, p_death_c=p_death_c, p_censor_c=p_censor_c, p_death_given_progression_c=p_death_given_progression_c, p_death_given_censor_c=p_death_given_censor_c
+    )
+
+    # a generator, so that only one chunk is simulated at a time
+    return add_shards(simulate_shard(size, duration, probabilities, seed_sequence, engine) for size, seed_sequence in zip(shard_sizes, seed_sequences))
+
+
+def get_cache_key(params, engine, seed, coupling=None):
+    """
+    Hash of everything that determines a simulated trial: the 12 simulation parameters, the seed, the engine version and
+    the coupling if any
+    """
+    key = {'params': params, 'seed': seed, 'engine': engine, 'version': ENGINE_VERSIONS[engine]}
+    if coupling is not None:
+        key['coupling'] = coupling
+    key = json.dumps(key, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def read_cached_trial(key):
+    path = os.path.join(CACHE_DIR, f'{key}.npz')
+    try:
+        with np.load(path) as cached:
+            arrays = dict(cached)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as error:
+        logger.warning(f'Could not read trial {key} from the cache in {CACHE_DIR}: {error}')
+        return None
+
+    # the modification time tracks the last use for the least recently used eviction; the entry may have been evicted
+    # by another process since it was loaded
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    meta = json.loads(str(arrays.pop('meta')))
+    if meta['kind'] == 'life_table':
+        data = pd.DataFrame(arrays)
+    else:
+        data = TrialData(**arrays, duration=meta['duration'])
+
+    return data, meta['hr_pfs'], meta['hr_os']
+
+
+@instrument('cache_write')
+def write_cached_trial(key, data, hr_pfs, hr_os, duration):
+    meta = {'hr_pfs': hr_pfs, 'hr_os': hr_os, 'duration': duration}
+    if is_life_table(data):
+        meta['kind'] = 'life_table'
+        arrays = {column: data[column].to_numpy() for column in data.columns}
+    else:
+        meta['kind'] = 'participants'
+        arrays = {column: getattr(data, column) for column in ['treated', 'progress_time', 'death_time', 'censor_time']}
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temporary_path = os.path.join(CACHE_DIR, f'{key}.{uuid.uuid4().hex}.tmp.npz')
+    try:
+        np.savez_compressed(temporary_path, meta=json.dumps(meta), **arrays)
+        os.replace(temporary_path, os.path.join(CACHE_DIR, f'{key}.npz'))
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    evict_cache()
+
+
+def evict_cache():
+    """
+    Removes the least recently used entries until the cache is below CACHE_SIZE_LIMIT bytes
+    """
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.npz') and '.tmp' not in entry.name:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    size = sum(entry[1] for entry in entries)
+    for _, entry_size, path in sorted(entries):
+        if size <= CACHE_SIZE_LIMIT:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        size -= entry_size
+
+
+@instrument('trial_write')
+def write_trial(path, data, params, engine, seed=None, compression=None, **metadata):
+    """
+    Writes a simulated trial to an Arrow IPC (Feather V2) file with the simulation parameters, engine and seed and any
+    further metadata (e.g. the hazard ratios). Participants, as TrialData or as returned by simulate_trial, are stored in
+    the compact columns of TrialData, life tables of an engine or of solve_trial (engine 'exact', without a version) as
+    they are. Uncompressed files are memory-mapped by read_trial without copying; with compression ('zstd' or 'lz4')
+    files are smaller, but read_trial has to decompress them.
+    """
+    import pyarrow as pa
+
+    meta = {**metadata, 'params': params, 'engine': engine, 'version': ENGINE_VERSIONS.get(engine), 'seed': seed}
+    if is_life_table(data):
+        meta['kind'] = 'life_table'
+        table = pa.Table.from_pandas(data, preserve_index=False)
+    else:
+        if isinstance(data, pd.DataFrame):
+            data = TrialData.from_frame(data)
+        elif not isinstance(data, TrialData):
+            raise ValueError(f'Participants of the four-state model are stored as TrialData, got {type(data).__name__}')
+        meta['kind'] = 'participants'
+        meta['duration'] = data.duration
+        # Arrow packs booleans into bits, stored as bytes the arm indicator can be mapped as it is
+        table = pa.table({
+            'treated': data.treated.view(np.uint8),
+            'progress_time': data.progress_time,
+            'death_time': data.death_time,
+            'censor_time': data.censor_time,
+        })
+
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'trial': json.dumps(meta).encode()})
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema, options=pa.ipc.IpcWriteOptions(compression=compression)) as writer:
+        writer.write_table(table)
+
+
+@instrument('trial_read')
+def read_trial(path):
+    """
+    Simulated trial written by write_trial and its metadata. Participants are returned as TrialData whose columns map
+    the file into memory, so only the pages that are used are read and nothing is copied for uncompressed files; the
+    arrays are read-only and the file must not be changed while they are in use.
+    """
+    import pyarrow as pa
+
+    reader = pa.ipc.open_file(pa.memory_map(path))
+    meta = json.loads(reader.schema.metadata[b'trial'])
+    table = reader.read_all()
+
+    if meta['kind'] == 'life_table':
+        return table.to_pandas(), meta
+
+    def as_array(name):
+        column = table.column(name)
+        return column.chunk(0).to_numpy() if column.num_chunks == 1 else column.to_numpy()
+
+    data = TrialData(as_array('treated').view(bool), as_array('progress_time'), as_array('death_time'), as_array('censor_time'), meta['duration'])
 
-    data_treated = data[data[group_col] == 1]
-    data_control = data[data[group_col] == 0]
+    return data, meta
 
-    kmf.fit(data_treated[time_col], data_treated[event_col], label='Treated')
-    kmf.plot(ci_show=False)
-    kmf.fit(data_control[time_col], data_control[event_col], label='Control')
-    kmf.plot(ci_show=False)
+
+@instrument('trial_results', arguments=['n', 'duration', 'engine'])
+def get_trial_results(n, duration, p_progression_t, p_death_t, p_censor_t, p_death_given_progression_t, p_death_given_censor_t, p_progression_c, p_death_c, p_censor_c, p_death_given_progression_c, p_death_given_censor_c, engine='study', seed=None, cache=True, coupling=None):
+    """
+    Simulated trial with its PFS and OS hazard ratios. The trial is returned as TrialData, or as a life table for the
+    'cohort' engine. Seeded runs are stored in an on-disk cache shared by the application and the examples, and read
+    from there when the same trial was simulated before. See simulate_trial_data for coupling.
+    """
+    params = dict(
+        n=n, duration=duration,
+        p_progression_t=p_progression_t, p_death_t=p_death_t, p_censor_t=p_censor_t, p_death_given_progression_t=p_death_given_progression_t, p_death_given_censor_t=p_death_given_censor_t,
+        p_progression_c=p_progression_c, p_death_c=p_death_c, p_censor_c=p_censor_c, p_death_given_progression_c=p_death_given_progression_c, p_death_given_censor_c=p_death_given_censor_c
+    )
+    cache = cache and seed is not None
+
+    if cache:
+        key = get_cache_key(params, engine, seed, coupling=coupling)
+        with measure_stage('cache_read') as record:
+            cached = read_cached_trial(key)
+            record['hit'] = cached is not None
+        if cached is not None:
+            return cached
+
+    if engine in PARTICIPANT_ENGINES:
+        data = simulate_trial_data(**params, engine=engine, seed=seed, coupling=coupling)
+    else:
+        data = simulate_trial(**params, engine=engine, seed=seed, coupling=coupling)
+    hr_pfs = get_hazard_ratio_pfs(data)
+    hr_os = get_hazard_ratio_os(data)
+
+    if cache:
+        # the cache only saves time, a trial that cannot be stored is still returned
+        try:
+            write_cached_trial(key, data, hr_pfs, hr_os, duration)
+        except OSError as error:
+            logger.warning(f'Could not write trial {key} to the cache in {CACHE_DIR}: {error}')
+
+    return data, hr_pfs, hr_os
+
+
+def get_curves(data, endpoint):
+    """
+    Survival curves of an endpoint of a simulated trial in any format, one row per group and time with a 'survival' column
+    """
+    if is_life_table(data):
+        return data[['group', 'time', f'{endpoint}_survival']].rename(columns={f'{endpoint}_survival': 'survival'})
+
+    if isinstance(data, ParticipantData):
+        return get_kaplan_meier(data.get_weighted_events(endpoint), 'time', 'event', 'group', weights_col='weight')
+
+    return get_kaplan_meier(data, f'{endpoint}_event_time', f'has_{endpoint}_event', 'group')
+
+@instrument('plot_kaplan_meier', get_fields=get_data_fields)
+def plot_kaplan_meier(data, time_col, event_col, group_col, alpha=None, ax=None):
+    plot_survival(get_kaplan_meier(data, time_col, event_col, group_col, alpha=alpha), 'survival', 'group', ax=ax)
+
+@instrument('plot')
+def plot_survival(data, survival_col, group_col, ax=None):
+    ax = ax if ax is not None else plt.gca()
+
+    for group, label in [(1, 'Treated'), (0, 'Control')]:
+        data_group = data[data[group_col] == group]
+        times = np.append(0, data_group['time'])
+        line, = ax.plot(times, np.append(1, data_group[survival_col]), drawstyle='steps-post', label=label)
+
+        if f'{survival_col}_lower' in data:
+            lower, upper = np.append(1, data_group[f'{survival_col}_lower']), np.append(1, data_group[f'{survival_col}_upper'])
+            ax.fill_between(times, lower, upper, step='post', color=line.get_color(), alpha=0.25, linewidth=0)
+
+    ax.set_xlabel('timeline')
+    ax.legend()
+
+def plot_endpoint(data, endpoint, ax=None):
+    plot_survival(get_curves(data, endpoint), 'survival', 'group', ax=ax)
+
+def get_plot_png(data, endpoint, figsize=PLOT_SIZE, dpi=PLOT_DPI):
+    """
+    Plot of the survival curves of an endpoint encoded as PNG. The figure is drawn with the Agg backend outside of
+    pyplot, so it is never registered globally and is freed once rendered. Encoded plots are cached by their curves and
+    options, the PLOT_CACHE_SIZE least recently used are kept.
+    """
+    with measure_stage('plot_png', endpoint=endpoint, n=get_participant_count(data)) as record:
+        curves = get_curves(data, endpoint)
+        key = hashlib.sha256(pd.util.hash_pandas_object(curves, index=False).values.tobytes() + repr((figsize, dpi)).encode()).hexdigest()
+
+        record['cached'] = key in PLOT_CACHE
+        if key in PLOT_CACHE:
+            PLOT_CACHE.move_to_end(key)
+            return PLOT_CACHE[key]
+
+        figure = Figure(figsize=figsize, dpi=dpi)
+        plot_survival(curves, 'survival', 'group', ax=figure.subplots())
+
+        buffer = io.BytesIO()
+        FigureCanvasAgg(figure).print_png(buffer)
+        png = buffer.getvalue()
+
+    PLOT_CACHE[key] = png
+    while len(PLOT_CACHE) > PLOT_CACHE_SIZE:
+        PLOT_CACHE.popitem(last=False)
+
+    return png
 
 def get_plot(df, hr_pfs, hr_os):
-    figure = plt.figure(figsize=(8, 4))
+    # drawn outside of pyplot, so figures do not accumulate in its registry
+    figure = Figure(figsize=(8, 4))
+    ax_pfs, ax_os = figure.subplots(1, 2)
+
+    ax_pfs.set_title(f'PFS\n(HR: {round(hr_pfs, 2)})')
+    plot_endpoint(df, 'pfs', ax=ax_pfs)
 
-    plt.subplot(1, 2, 1)
-    plt.title(f'PFS\n(HR: {round(hr_pfs, 2)})')
-    plot_kaplan_meier(df, 'pfs_event_time', 'has_pfs_event', 'group')
+    ax_os.set_title(f'OS\n(HR: {round(hr_os, 2)})')
+    plot_endpoint(df, 'os', ax=ax_os)
 
-    plt.subplot(1, 2, 2)
-    plt.title(f'OS\n(HR: {round(hr_os, 2)})')
-    plot_kaplan_meier(df, 'os_event_time', 'has_os_event', 'group')
-        
-    return figure
\ No newline at end of file
+    return figure
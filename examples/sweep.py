@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from simulation import simulate_trial, get_arm_params, get_hazard_ratio_pfs, get_hazard_ratio_os, is_life_table
+
+# parameters of simulate_trial that a sweep can vary, in the order they are stored
+PARAMS = [
+    'n', 'duration',
+    'p_progression_t', 'p_death_t', 'p_censor_t', 'p_death_given_progression_t', 'p_death_given_censor_t',
+    'p_progression_c', 'p_death_c', 'p_censor_c', 'p_death_given_progression_c', 'p_death_given_censor_c',
+]
+INTEGER_PARAMS = ['n', 'duration']
+# types the parameters are stored with, so that part files agree however the values of a point were written, e.g. a
+# probability of 0 instead of 0.0
+PARAM_DTYPES = {name: 'int64' if name in INTEGER_PARAMS else 'float64' for name in PARAMS}
+
+# number of finished points collected before they are written as a new part file
+FLUSH_EVERY = 1000
+
+# types of the result columns that can be missing, so that part files with and without failed points share a schema
+RESULT_DTYPES = {'events_pfs': 'Int64', 'events_os': 'Int64', 'error': 'string'}
+
+
+def get_grid(base, grid):
+    """
+    All combinations of the values in grid ({parameter: values}), with the remaining parameters taken from base
+    """
+    names = list(grid)
+    return [{**base, **dict(zip(names, values))} for values in product(*(grid[name] for name in names))]
+
+
+def get_latin_hypercube(base, bounds, points, seed=None):
+    """
+    Latin hypercube design of the given number of points over bounds ({parameter: (low, high)}), with the remaining
+    parameters taken from base. Each parameter's range is split into as many strata as there are points and every
+    stratum is sampled exactly once.
+    """
+    rng = np.random.default_rng(seed)
+
+    design = [dict(base) for _ in range(points)]
+    for name, (low, high) in bounds.items():
+        values = low + (high - low) * (rng.permutation(points) + rng.random(points)) / points
+        if name in INTEGER_PARAMS:
+            values = np.round(values).astype(int)
+        for point, value in zip(design, values):
+            point[name] = value.item()
+
+    return design
+
+
+def get_point_id(params, engine, seed):
+    key = json.dumps({'params': {name: params[name] for name in PARAMS}, 'engine': engine, 'seed': seed}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def get_point_seed(point_id, seed):
+    """
+    Seed of a single point, derived from the sweep seed and the point so that results do not depend on the order of evaluation
+    """
+    return int(np.random.SeedSequence([seed or 0, int(point_id, 16)]).generate_state(1)[0])
+
+
+def get_event_count(data, endpoint):
+    if is_life_table(data):
+        return int(data[f'events_{endpoint}'].sum())
+
+    return int(data[f'has_{endpoint}_event'].sum())
+
+
+def check_point(params):
+    # not every engine rejects an arm whose transition probabilities out of the non-progressed state exceed one
+    arm_params = get_arm_params(**{name: params[name] for name in PARAMS if name not in INTEGER_PARAMS})
+    for suffix, probabilities in zip(('t', 'c'), arm_params):
+        if min(probabilities) < 0 or max(probabilities) > 1 or sum(probabilities[:3]) > 1:
+            raise ValueError(f'Invalid transition probabilities {probabilities} of arm {suffix}')
+
+
+def evaluate_point(point_id, params, engine, seed):
+    """
+    Hazard ratios and event counts of a single point. A point whose parameters are rejected is returned with missing
+    results and the reason in error, so that it is recorded as finished rather than aborting the sweep.
+    """
+    start = time.perf_counter()
+
+    row = {'point_id': point_id, **{name: params[name] for name in PARAMS}, 'engine': engine, 'seed': seed}
+    try:
+        check_point(params)
+        df_trial = simulate_trial(**{name: params[name] for name in PARAMS}, engine=engine, seed=seed)
+        hr_pfs = get_hazard_ratio_pfs(df_trial)
+        hr_os = get_hazard_ratio_os(df_trial)
+    except ValueError as error:
+        return {
+            **row,
+            'hr_pfs': np.nan, 'hr_os': np.nan, 'hr_ratio': np.nan, 'events_pfs': None, 'events_os': None,
+            'runtime': time.perf_counter() - start,
+            'error': str(error),
+        }
+
+    return {
+        **row,
+        'hr_pfs': hr_pfs,
+        'hr_os': hr_os,
+        'hr_ratio': hr_pfs / hr_os,
+        'events_pfs': get_event_count(df_trial, 'pfs'),
+        'events_os': get_event_count(df_trial, 'os'),
+        'runtime': time.perf_counter() - start,
+        'error': None,
+    }
+
+
+def read_sweep(path):
+    """
+    All results written so far by run_sweep to the directory path
+    """
+    if not os.path.isdir(path) or not any(name.endswith('.parquet') for name in os.listdir(path)):
+        return pd.DataFrame(columns=['point_id'])
+
+    return pd.read_parquet(path)
+
+
+def write_part(rows, path):
+    # every flush goes to a new file, so an interruption can at most lose the points of the current buffer; the file is
+    # written under a name that Parquet readers skip and renamed once complete
+    file_name = f'part-{uuid.uuid4().hex}.parquet'
+    temporary_path = os.path.join(path, f'_{file_name}.tmp')
+    pd.DataFrame(rows).astype({**PARAM_DTYPES, **RESULT_DTYPES}).to_parquet(temporary_path, index=False)
+    os.replace(temporary_path, os.path.join(path, file_name))
+
+
+def run_sweep(points, path, engine='cohort', seed=None, workers=None, flush_every=FLUSH_EVERY):
+    """
+    Evaluates simulate_trial with the hazard ratios and event counts at every parameter set in points on a process pool
+    and streams the results into Parquet part files in the directory path. Points already present in path are skipped,
+    so an interrupted sweep resumes where it stopped when it is run again with the same arguments. Points with invalid
+    parameters, such as transition probabilities summing to more than one, are recorded with their error instead of
+    results and are not retried.
+    Scripts using this on platforms that spawn worker processes need an if __name__ == '__main__' guard.
+    Returns all results of the sweep.
+    """
+    os.makedirs(path, exist_ok=True)
+    finished = set(read_sweep(path)['point_id'])
+
+    pending = {}
+    for params in points:
+        point_id = get_point_id(params, engine, seed)
+        if point_id not in finished:
+            pending[point_id] = params
+
+    print(f'Sweep with {len(points)} points, {len(pending)} left to evaluate...')
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            evaluate_point,
+            list(pending), list(pending.values()), [engine] * len(pending), [get_point_seed(point_id, seed) for point_id in pending],
+            chunksize=max(1, min(100, len(pending) // (4 * (workers or os.cpu_count())))),
+        )
+        for row in results:
+            rows.append(row)
+            if len(rows) >= flush_every:
+                write_part(rows, path)
+                rows = []
+
+    if rows:
+        write_part(rows, path)
+
+    df_sweep = read_sweep(path)
+    failed = df_sweep['error'].notna().sum() if 'error' in df_sweep else 0
+    if failed:
+        print(f'{failed} points failed, see the error column')
+
+    return df_sweep
+
+
+if __name__ == '__main__':
+    from settings import settings
+
+    # how the PFS/OS gap in the first article setting responds to the death rates after progression
+    base = {**settings['1_progression_driven_low_translation'], 'n': 10 * 1000}
+    points = get_grid(base, {
+        'p_death_given_progression_t': np.linspace(0.0125, 0.1, 8).tolist(),
+        'p_death_given_progression_c': np.linspace(0.0125, 0.1, 8).tolist(),
+    })
+
+    df_sweep = run_sweep(points, os.path.join(os.path.dirname(__file__), 'sweeps', 'death_given_progression'), seed=42)
+    print(df_sweep.pivot_table(index='p_death_given_progression_t', columns='p_death_given_progression_c', values='hr_ratio').round(3))
@@ -0,0 +1,59 @@
+import time
+import warnings
+
+import pandas as pd
+from lifelines import CoxPHFitter
+
+from settings import settings
+from simulation import simulate_trial, get_hr_estimate
+
+# lifelines needs minutes per fit at the article's sample size, a smaller trial suffices to compare the estimators
+N = 20 * 1000
+SEED = 42
+
+ENDPOINTS = {
+    'pfs': ('pfs_event_time', 'has_pfs_event'),
+    'os': ('os_event_time', 'has_os_event'),
+}
+
+rows = []
+
+for setting, params in settings.items():
+    df_trial = simulate_trial(**{**params, 'n': N}, engine='direct', seed=SEED)
+
+    for endpoint, (time_col, event_col) in ENDPOINTS.items():
+        start = time.perf_counter()
+        cph = CoxPHFitter()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            cph.fit(df_trial[[time_col, event_col, 'group']], duration_col=time_col, event_col=event_col)
+        time_lifelines = time.perf_counter() - start
+
+        start = time.perf_counter()
+        efron = get_hr_estimate(df_trial, time_col, event_col, 'group')
+        time_native = time.perf_counter() - start
+        breslow = get_hr_estimate(df_trial, time_col, event_col, 'group', ties='breslow')
+
+        summary = cph.summary.iloc[0]
+        rows.append({
+            'setting': setting,
+            'endpoint': endpoint,
+            'hr_lifelines': summary['exp(coef)'],
+            'hr_efron': efron['hr'],
+            'hr_breslow': breslow['hr'],
+            'se_lifelines': summary['se(coef)'],
+            'se_efron': efron['se'],
+            'ci_lower_diff': abs(summary['exp(coef) lower 95%'] - efron['ci_lower']),
+            'ci_upper_diff': abs(summary['exp(coef) upper 95%'] - efron['ci_upper']),
+            'time_lifelines': time_lifelines,
+            'time_native': time_native,
+        })
+
+df_validation = pd.DataFrame(rows)
+df_validation['hr_diff'] = (df_validation['hr_lifelines'] - df_validation['hr_efron']).abs()
+df_validation['se_diff'] = (df_validation['se_lifelines'] - df_validation['se_efron']).abs()
+
+with pd.option_context('display.width', 200, 'display.max_columns', None):
+    print(df_validation)
+
+print(f"\nLargest differences to lifelines: HR {df_validation['hr_diff'].max():.2e}, SE {df_validation['se_diff'].max():.2e}")
@@ -0,0 +1,45 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from settings import settings
+from simulation import solve_trial, write_trial, read_trial
+from sweep import get_grid, run_sweep
+
+# checks that results written to disk are read back completely, with a small trial per point
+N = 500
+SEED = 42
+
+with tempfile.TemporaryDirectory() as directory:
+    # the article settings have integer censoring probabilities of 0; mixed with floats and one point per part file,
+    # the parts must still share a schema for the sweep to be read and resumed
+    base = {**settings['1_progression_driven_low_translation'], 'n': N}
+    points = get_grid(base, {'p_censor_t': [0, 0.05], 'p_censor_c': [0, 0.05]})
+    path = os.path.join(directory, 'sweep')
+
+    df_sweep = run_sweep(points, path, seed=SEED, workers=1, flush_every=1)
+    # which part is read first is arbitrary, so the schemas are compared directly as well
+    schemas = [pq.read_schema(os.path.join(path, name)) for name in os.listdir(path)]
+    assert all(schema.equals(schemas[0]) for schema in schemas)
+    assert len(df_sweep) == len(points) and df_sweep['error'].isna().all()
+    assert df_sweep['p_censor_t'].dtype == np.float64 and df_sweep['n'].dtype == np.int64
+
+    df_resumed = run_sweep(points, path, seed=SEED, workers=1, flush_every=1)
+    assert len(df_resumed) == len(points)
+
+    print(f'Sweep with mixed integer and float parameters: {len(df_sweep)} points in {len(os.listdir(path))} part files read and resumed')
+
+    # life tables of the exact solver are stored as they are, like those of the cohort engine
+    params = settings['1_progression_driven_low_translation']
+    lt_exact = solve_trial(**params)
+    path = os.path.join(directory, 'exact.arrow')
+
+    write_trial(path, lt_exact, params, 'exact')
+    lt_read, meta = read_trial(path)
+    pd.testing.assert_frame_equal(lt_read, lt_exact)
+    assert meta['engine'] == 'exact' and meta['version'] is None and meta['params'] == params
+
+    print(f'Exact life table with {len(lt_read)} rows written and read back unchanged')